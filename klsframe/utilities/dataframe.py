@@ -1,13 +1,72 @@
 import collections
-import copy
-from functools import reduce
-from typing import Union
-
+import collections.abc
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+from functools import partial, reduce
+from typing import Optional, Union
+
+import numpy as np
 import pandas as pd
 import re
 
 from klsframe.protypes import klists as _klists
 import klsframe.utilities.utils as _kutils
+import klsframe.utilities.serializer as _kser
+
+_PAGE_FORMATS = {
+    'parquet': (lambda df, path: df.to_parquet(path), lambda path: pd.read_parquet(path, memory_map=True)),
+    'feather': (lambda df, path: df.to_feather(path), pd.read_feather),
+}
+_MANIFEST_FILE = 'manifest.json'
+_EXCEL_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'klsframe-excel')
+_PREVIEW_ROWS = 10
+_PREVIEW_PAGES = 20
+
+
+@contextlib.contextmanager
+def _executor_pool(executor, max_workers=None):
+    # Executor instances are provided by the caller, so they are not shut down here
+    if isinstance(executor, concurrent.futures.Executor):
+        yield executor
+    elif executor == 'thread':
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            yield pool
+    elif executor == 'process':
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+            yield pool
+    else:
+        raise ValueError("Unexpected value for parameter 'executor'. Allowed: thread|process|Executor")
+
+
+class LazyPage:
+    """
+    Handle to a `DataFrameCollection` page stored on disk. The page is read the first time it is accessed
+
+    :param path: File containing the page
+    :param loader: Function that receives ``path`` and returns a DataFrame. If None, it is chosen
+        from the file extension (.parquet, .feather)
+    """
+
+    def __init__(self, path, loader=None):
+        self.path = str(path)
+        if loader is None:
+            ext = os.path.splitext(self.path)[1].lstrip('.')
+            if ext not in _PAGE_FORMATS:
+                raise ValueError(f"Unknown page format '{ext}'. Provide a loader or use: {list(_PAGE_FORMATS.keys())}")
+            loader = _PAGE_FORMATS[ext][1]
+        self.loader = loader
+
+    def __repr__(self):
+        return f"LazyPage('{self.path}')"
+
+    def load(self) -> pd.DataFrame:
+        return self.loader(self.path)
 
 
 class DataFrameCollection(dict):
@@ -15,9 +74,17 @@ class DataFrameCollection(dict):
     Custom collection, extending from `dict`, whose keys represent page names and the values pandas DataFrames.
     It is similar to an Excel book, but only in-memory and uses DataFrames instead of Excel workbooks.
     This class eases data export (to Excel), printing, merging... it can be seen as a workspace for dataframes
+
+    Pages can also be `LazyPage` handles, which are read from disk the first time they are accessed.
+    If a ``memory_budget`` (bytes) is set, the least recently used pages read from a `LazyPage` are evicted
+    back to their handle whenever the loaded pages exceed the budget. In-place changes of an evicted page are lost,
+    assign the page again (e.g. with `update`) to keep it in memory.
     """
 
-    def __init__(self, seq=None, **kwargs):
+    def __init__(self, seq=None, memory_budget=None, **kwargs):
+        self.memory_budget = memory_budget
+        self._loaded_pages = collections.OrderedDict()  # Page name -> (LazyPage, DataFrame, bytes), LRU order
+        self.errors = {}  # Page name -> exception raised by `map_pages`
         super().__init__(**kwargs)
         if seq is None:
             pass
@@ -29,17 +96,97 @@ class DataFrameCollection(dict):
     def __repr__(self):
         return f"DataFrameCollection({[k for k in self.keys()]})"
 
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if isinstance(value, LazyPage):
+            handle, value = value, value.load()
+            super().__setitem__(key, value)
+            self._loaded_pages[key] = (handle, value, int(value.memory_usage(deep=True).sum()))
+            self._evict()
+        elif key in self._loaded_pages:
+            self._loaded_pages.move_to_end(key)
+        return value
+
+    # Replaced or removed pages are no longer tracked as loaded, so their frames can be freed
+    def __setitem__(self, key, value):
+        self._loaded_pages.pop(key, None)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._loaded_pages.pop(key, None)
+        super().__delitem__(key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def pop(self, key, *default):
+        self._loaded_pages.pop(key, None)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._loaded_pages.pop(key, None)
+        return key, value
+
+    def clear(self):
+        self._loaded_pages.clear()
+        super().clear()
+
+    def _evict(self) -> None:
+        while self.memory_budget is not None and len(self._loaded_pages) > 1 and \
+                self.loaded_bytes() > self.memory_budget:
+            dfname, (handle, value, _) = self._loaded_pages.popitem(last=False)
+            # Skip pages that were removed or replaced since they were loaded
+            if dfname in self.keys() and super().__getitem__(dfname) is value:
+                super().__setitem__(dfname, handle)
+
+    def loaded_bytes(self) -> int:
+        """
+        :return: Memory usage (bytes) of the pages currently loaded from a `LazyPage`
+        """
+        return sum(nbytes for _, _, nbytes in self._loaded_pages.values())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        return collections.abc.ItemsView(self)
+
+    def values(self):
+        return collections.abc.ValuesView(self)
+
     def __str__(self):
-        _str = ""
-        for ind, (dfname, dfcontents) in enumerate(self.items(), 1):
-            _str += f"Page '{dfname}'\n\n{dfcontents}\n{'-' * 18} pg {ind} {'-' * 18}\n"
-        return _str
+        _str = io.StringIO()
+        self.render(_str, max_rows=_PREVIEW_ROWS, max_pages=_PREVIEW_PAGES, load=False)
+        return _str.getvalue()
+
+    def to_string(self, max_rows=None):
+        _str = io.StringIO()
+        self.render(_str, max_rows=max_rows)
+        return _str.getvalue()
 
-    def to_string(self):
-        _str = ""
-        for ind, (dfname, dfcontents) in enumerate(self.items(), 1):
-            _str += f"Page '{dfname}'\n\n{dfcontents.to_string()}\n{'-' * 18} pg {ind} {'-' * 18}\n"
-        return _str
+    def render(self, stream=None, max_rows=None, max_pages=None, load=True) -> None:
+        """
+        Writes the pages of this DataFrameCollection one by one to a file-like object,
+        so the whole collection is never rendered into a single string
+
+        :param stream: File-like object (anything with a `write` method). By default, `sys.stdout`
+        :param max_rows: Maximum number of rows rendered per page. If None (default), all the rows are rendered
+        :param max_pages: Maximum number of pages rendered. If None (default), all the pages are rendered
+        :param load: If True (default), `LazyPage` handles are loaded to be rendered. Otherwise, the handle is shown
+        :return: None
+        """
+        stream = sys.stdout if stream is None else stream
+        for ind, dfname in enumerate(self.keys(), 1):
+            if max_pages is not None and ind > max_pages:
+                stream.write(f"... {len(self) - max_pages} more pages\n")
+                break
+            dfcontents = self[dfname] if load else dict.__getitem__(self, dfname)
+            if isinstance(dfcontents, pd.DataFrame):
+                dfcontents = dfcontents.to_string(max_rows=max_rows,
+                                                  show_dimensions='truncate' if max_rows is not None else False)
+            stream.write(f"Page '{dfname}'\n\n{dfcontents}\n{'-' * 18} pg {ind} {'-' * 18}\n")
 
     def add(self, dfname, dfdata=None):
         if dfname in self:
@@ -47,47 +194,219 @@ class DataFrameCollection(dict):
         else:
             self.update({dfname: dfdata if dfdata is not None else pd.DataFrame()})
 
-    def to_excel(self, outfile, inlcude=None, exclude=None) -> None:
+    def to_excel(self, outfile, include=None, exclude=None, streaming=False, **kwargs) -> None:
         """
-        TODO: implement include param like in function `combine`
-        Saves the content of this DataFrameCollection instance into an Excel book
+        Saves the content of this DataFrameCollection instance into an Excel book.
+        The pages are picked by name, no dataframe is copied.
 
         :param outfile: Name for the output Excel book (file extension not needed, it is implicit)
+        :param include: List containing the page names included in the output Excel book.
+                Cannot be used together with ``exclude``
         :param exclude: List containing the page names excluded of the output Excel book.
-                If None, no pages are excluded. If this param contains a page name that does not exist
+                If None, no pages are excluded. Cannot be used together with ``include``.
+                If ``include`` or ``exclude`` contain a page name that does not exist
                 within this `DataFrameCollection` instance, the user will be warned and the page name skipped,
                 causing no exception
+        :param streaming: If True, the pages are written row by row with a constant-memory writer.
+                Check `df_to_excel`
+        :param kwargs: Additional arguments for `dataframe.df_to_excel`
         :return: None
         """
-        exclude = _kutils.assign_if_not_none(exclude, if_not_none=lambda x: _klists.list_wrap(x), if_none=[])
-        aux = copy.deepcopy(self)
-        for dfname in exclude:
-            try:
-                aux.pop(dfname)
-            except KeyError:
+        targets = self._select_pages(include, exclude)
+        requested = include if include is not None else exclude
+        for dfname in _kutils.assign_if_not_none(requested, if_not_none=lambda x: _klists.list_wrap(x), if_none=[]):
+            if dfname not in self:
                 print(f"[WARN] The specified df ('{dfname}') in not included in this collection")
-        df_to_excel(outfile, aux)
+        df_to_excel(outfile, {n: self[n] for n in targets if n in self}, streaming=streaming, **kwargs)
 
-    def combine(self, on: Union[str, list], include=None, exclude=None, **kwargs):
+    def _select_pages(self, include=None, exclude=None) -> list:
+        if include is None and exclude is None:
+            return list(self.keys())
+        elif include is not None and exclude is None:
+            return _klists.list_wrap(include)
+        elif include is None and exclude is not None:
+            exclude = _klists.list_wrap(exclude)
+            return [k for k in self.keys() if k not in exclude]
+        else:
+            raise ValueError("Parameters 'include' and 'exclude' are mutually exclusive and cannot be use together")
+
+    def plan_combine(self, on: Union[str, list], include=None, exclude=None, how='inner') -> 'MergePlan':
+        """
+        Computes the `MergePlan` that `combine` would use, without merging anything.
+        Useful to inspect the chosen merge order (``plan.names``) and the estimates (``plan.stats``)
+
+        :param on: Column(s) on which the merge will be applied
+        :param include: Pages to be included. Cannot be used together with ``exclude``
+        :param exclude: Pages to be excluded. Cannot be used together with ``include``
+        :param how: How to do the merge
+        :return: The `MergePlan` for the specified pages
+        """
+        targets = self._select_pages(include, exclude)
+        return plan_merge([self.get(n) for n in targets], on=on, how=how, names=targets)
+
+    def combine(self, on: Union[str, list], include=None, exclude=None, plan=True, **kwargs):
         """
         Combine the dataframes included in this instance of `DataFrameCollection`
 
         :param on: Column(s) on which the merge will be applied
         :param include: Pages to be included. Cannot be used together with ``exclude``
         :param exclude: Pages to be excluded. Cannot be used together with ``include``
+        :param plan: True (default) to merge the pages in the order chosen by `plan_merge`. False to merge them
+            in insertion order. A `MergePlan` obtained from `plan_combine` can be provided as well, as long as
+            it was computed with the same ``on``, ``how`` and pages (otherwise, a `ValueError` is raised)
         :param kwargs: Additional arguments for `dataframe.multi_merge`
         :return: The dataframe resulting from merging the specified pages
         """
-        if include is None and exclude is None:
-            targets = list(self.keys())
-        elif include is not None and exclude is None:
-            targets = _klists.list_wrap(include)
-        elif include is None and exclude is not None:
-            targets = list(set(self.keys()) - set(_klists.list_wrap(exclude)))
-        else:
-            raise ValueError("Parameters 'include' and 'exclude' are mutually exclusive and cannot be use together")
+        targets = self._select_pages(include, exclude)
         aux = [self.get(n) for n in targets]
-        return multi_merge(aux, on=on, **kwargs)
+        if plan is True and kwargs.get('strategy', 'reduce') == 'reduce':
+            plan = plan_merge(aux, on=on, how=kwargs.get('how', 'inner'), names=targets)
+        return multi_merge(aux, on=on, plan=plan, **kwargs)
+
+    def map_pages(self, func, executor='thread', max_workers=None, include=None, exclude=None, errors='collect'):
+        """
+        Applies a function to every page in a thread or process pool
+
+        :param func: Function that receives a page (DataFrame). It must be picklable when using processes
+        :param executor: 'thread' (default), 'process', or an existing `concurrent.futures.Executor`
+            (it will not be shut down)
+        :param max_workers: Maximum number of workers of the pool. By default, the executor default.
+            Ignored if ``executor`` is an Executor instance
+        :param include: Pages to be included. Cannot be used together with ``exclude``
+        :param exclude: Pages to be excluded. Cannot be used together with ``include``
+        :param errors: 'collect' (default) to skip the failed pages and keep their exception in the ``errors``
+            attribute of the result (page name -> exception). 'raise' to raise the error of the first failed page
+        :return: A new DataFrameCollection with the result of each page, under the same page name and order
+        """
+        if errors not in ['collect', 'raise']:
+            raise ValueError("Unexpected value for parameter 'errors'. Allowed: collect|raise")
+        targets = self._select_pages(include, exclude)
+        with _executor_pool(executor, max_workers) as pool:
+            futures = [pool.submit(func, self[n]) for n in targets]
+            dfcoll = DataFrameCollection()
+            for dfname, future in zip(targets, futures):
+                try:
+                    dict.__setitem__(dfcoll, dfname, future.result())
+                except Exception as e:
+                    if errors == 'raise':
+                        raise
+                    dfcoll.errors[dfname] = e
+            return dfcoll
+
+    def group_and_aggregate(self, group_by, aggregations: dict = None, include=None, exclude=None,
+                            executor='thread', max_workers=None, **kwargs):
+        """
+        Applies `dataframe.group_and_aggregate` to every page, page by page in parallel (see `map_pages`)
+
+        :param group_by: Columns (names) where the group by will be applied
+        :param aggregations: (Optional) named aggregations. Check `dataframe.group_and_aggregate`
+        :param include: Pages to be included. Cannot be used together with ``exclude``
+        :param exclude: Pages to be excluded. Cannot be used together with ``include``
+        :param executor: 'thread' (default), 'process' or an existing `concurrent.futures.Executor`
+        :param max_workers: Maximum number of workers. By default, the executor default
+        :param kwargs: Additional arguments for `dataframe.group_and_aggregate`
+        :return: A new DataFrameCollection with the result of each page, under the same page name
+        """
+        func = partial(group_and_aggregate, group_by=group_by, aggregations=aggregations, **kwargs)
+        return self.map_pages(func, executor=executor, max_workers=max_workers, include=include, exclude=exclude,
+                              errors='raise')
+
+    def optimize_memory(self, include=None, exclude=None, **kwargs) -> dict:
+        """
+        Replaces the selected pages by their `dataframe.compact_dtypes` version
+
+        :param include: Pages to be included. Cannot be used together with ``exclude``
+        :param exclude: Pages to be excluded. Cannot be used together with ``include``
+        :param kwargs: Additional arguments for `dataframe.compact_dtypes`
+        :return: A dict with the bytes saved in each page (page name -> bytes)
+        """
+        saved = {}
+        for dfname in self._select_pages(include, exclude):
+            before = self[dfname]
+            after = compact_dtypes(before, **kwargs)
+            saved[dfname] = int(before.memory_usage(deep=True).sum() - after.memory_usage(deep=True).sum())
+            self.update({dfname: after})
+        return saved
+
+    def save(self, path, fmt='parquet') -> None:
+        """
+        Saves this DataFrameCollection into a directory: one columnar file per page, plus a manifest
+        with the page names. Requires `pyarrow` (or `fastparquet` for the parquet format)
+
+        :param path: Output directory. It is created if it does not exist
+        :param fmt: Columnar format of the page files: 'parquet' (default) or 'feather'.
+            The feather format only supports dataframes with a default index
+        :return: None
+        """
+        if fmt not in _PAGE_FORMATS:
+            raise ValueError(f"Unexpected value for parameter 'fmt'. Allowed: {list(_PAGE_FORMATS.keys())}")
+        os.makedirs(path, exist_ok=True)
+        manifest = {'format': fmt, 'pages': []}
+        for ind, dfname in enumerate(self.keys()):
+            filename = f"page-{ind}.{fmt}"
+            _PAGE_FORMATS[fmt][0](self[dfname], os.path.join(path, filename))
+            manifest['pages'].append({'name': dfname, 'file': filename})
+        _kser.save_json(manifest, os.path.join(path, _MANIFEST_FILE))
+
+    @staticmethod
+    def load(path, lazy=True, memory_budget=None):
+        """
+        Loads a DataFrameCollection previously stored with `save`
+
+        :param path: Directory where the collection was saved
+        :param lazy: If True (default), each page is read from disk the first time it is accessed.
+            Otherwise, all the pages are read immediately
+        :param memory_budget: (Optional) memory budget (bytes) for the lazy pages. Check `DataFrameCollection`
+        :return: A new DataFrameCollection
+        """
+        manifest = _kser.load_json(os.path.join(path, _MANIFEST_FILE))
+        dfcoll = DataFrameCollection(memory_budget=memory_budget)
+        for page in manifest['pages']:
+            handle = LazyPage(os.path.join(path, page['file']), loader=_PAGE_FORMATS[manifest['format']][1])
+            dict.__setitem__(dfcoll, page['name'], handle if lazy else handle.load())
+        return dfcoll
+
+    @staticmethod
+    def from_excel(path, sheets=None, usecols=None, dtype=None, executor='thread', max_workers=None,
+                   cache_dir=_EXCEL_CACHE_DIR):
+        """
+        Reads an Excel book (e.g. written by `df_to_excel`) into a new DataFrameCollection, one page per sheet.
+        The sheets are read concurrently, and the parsed result is cached (see `save`) keyed on the
+        file path, modification time and size, and on the reading parameters.
+        Repeated reads of an unchanged book are served from the cache, loading the pages lazily
+
+        :param path: Path to the Excel book
+        :param sheets: Sheet name, or list of sheet names, to be read. If None (default), all the sheets are read
+        :param usecols: Columns to be read. Check `pandas.read_excel`
+        :param dtype: Data type for the data or the columns. Check `pandas.read_excel`
+        :param executor: 'thread' (default), 'process' or an existing `concurrent.futures.Executor`.
+            Parsing is CPU bound, thus processes scale better with the number of sheets
+        :param max_workers: Maximum number of workers. By default, the executor default
+        :param cache_dir: Directory for the parsed books. By default, $TEMP/klsframe-excel. If None, caching is disabled
+        :return: A new DataFrameCollection whose page names are the sheet names
+        """
+        stat = os.stat(path)
+        cached = None
+        if cache_dir is not None:
+            key = repr((os.path.abspath(path), stat.st_mtime_ns, stat.st_size, sheets, usecols, dtype))
+            cached = os.path.join(cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest())
+            if os.path.isfile(os.path.join(cached, _MANIFEST_FILE)):
+                return DataFrameCollection.load(cached)
+        if sheets is None:
+            with pd.ExcelFile(path) as book:
+                sheets = book.sheet_names
+        sheets = _klists.list_wrap(sheets)
+        reader = partial(pd.read_excel, path, usecols=usecols, dtype=dtype)
+        with _executor_pool(executor, max_workers) as pool:
+            futures = [pool.submit(reader, sheet_name=sheet) for sheet in sheets]
+            dfcoll = DataFrameCollection({sheet: future.result() for sheet, future in zip(sheets, futures)})
+        if cached is not None:
+            try:
+                dfcoll.save(cached)
+            except Exception as e:  # e.g. pyarrow cannot store mixed-type columns, common in Excel
+                print(f"[WARN] The parsed book could not be cached: {e}")
+                shutil.rmtree(cached, ignore_errors=True)
+        return dfcoll
 
     @staticmethod
     def fromkeys(*args):
@@ -96,11 +415,88 @@ class DataFrameCollection(dict):
         return dfcoll
 
 
-def get_df_rows(df, rindex=None):
+RowSelector = collections.namedtuple('RowSelector', ['kind', 'key'])
+"""
+Compiled form of a `rindex` row selector (see `compile_rindex`).
+
+- kind: one of 'all', 'label', 'first', 'last', 'labels', 'positions'
+- key: the index label, positional slice or ``(labels, ranges)`` tuple to be applied (None for 'all', 'first'
+  and 'last'). Ranges are kept as ``(start, end)`` bounds, both included, so they are never expanded
+"""
+
+_RINDEX_HEAD = re.compile('head-([0-9]+)')
+_RINDEX_TAIL = re.compile('tail-([0-9]+)')
+_RINDEX_RANGE = re.compile('([0-9]+)-([0-9]+)')
+_RINDEX_LIST = re.compile('([0-9]+(-[0-9]+)?,)*[0-9]+(-[0-9]+)?')
+
+
+def compile_rindex(rindex=None) -> RowSelector:
+    """
+    Compiles a row selector into a `RowSelector`, so it can be applied to one or more dataframes
+    without being parsed again. Check `get_df_rows` for the accepted grammar.
+
+    Explicit indexes (``1``, ``1-4``, ``2,3,7-9``) are matched against the index labels, ``first`` and ``last``
+    select the first/last valid index label (see `pandas.DataFrame.first_valid_index`),
+    while ``head-N`` and ``tail-N`` are positional.
+
+    :param rindex: Row selector to be compiled. Already compiled selectors are returned unchanged
+    :return: A `RowSelector` tuple
     """
-    Get the specified rows of a Pandas data frame
+    if isinstance(rindex, RowSelector):
+        return rindex
+    elif rindex is None:
+        return RowSelector('all', None)
+    elif isinstance(rindex, (int, np.integer)) and not isinstance(rindex, bool):
+        return RowSelector('label', rindex)
+    rindex = str(rindex)
+    if rindex in ['first', 'last']:
+        return RowSelector(rindex, None)
+    elif _RINDEX_HEAD.fullmatch(rindex):
+        return RowSelector('positions', slice(0, int(_RINDEX_HEAD.fullmatch(rindex).group(1))))
+    elif _RINDEX_TAIL.fullmatch(rindex):
+        size = int(_RINDEX_TAIL.fullmatch(rindex).group(1))
+        return RowSelector('positions', slice(-size, None) if size > 0 else slice(0, 0))
+    elif _RINDEX_LIST.fullmatch(rindex):
+        labels, ranges = [], []
+        for i in rindex.split(','):
+            bounds = _RINDEX_RANGE.fullmatch(i)
+            if bounds is None:
+                labels.append(int(i))
+            else:
+                ranges.append((int(bounds.group(1)), int(bounds.group(2))))
+        return RowSelector('labels', (np.unique(labels), tuple(ranges)))
+    else:
+        raise ValueError("Unexpected value for parameter 'rindex'")
+
+
+def _select_rows(df, selector: RowSelector) -> pd.DataFrame:
+    if selector.kind == 'all':
+        return df
+    elif selector.kind == 'label':
+        return df.loc[[selector.key]] if selector.key in df.index else df.iloc[0:0]
+    elif selector.kind in ['first', 'last']:
+        label = df.first_valid_index() if selector.kind == 'first' else df.last_valid_index()
+        return df.loc[[label]] if label is not None else df.iloc[0:0]
+    elif selector.kind == 'positions':
+        return df.iloc[selector.key]
+    else:
+        labels, ranges = selector.key
+        mask = df.index.isin(labels)
+        if len(ranges) > 0 and pd.api.types.is_numeric_dtype(df.index):
+            for start, end in ranges:
+                mask |= (df.index >= start) & (df.index <= end)
+        return df.loc[mask]
+
+
+def get_df_rows(df, rindex=None, as_frame=False):
+    """
+    Get the specified rows of a Pandas data frame.
+
+    The selector is compiled once (see `compile_rindex`) and applied with `.loc`/`.iloc`,
+    so the rows that are not selected are never materialized.
+
     :param df: Pandas dataframe to be scrapped
-    :param rindex: Index of the rows to retrieve. It accepts strings and integer numbers. Accepted:
+    :param rindex: Index of the rows to retrieve. It accepts strings, integer numbers and `RowSelector`. Accepted:
         - None (default): all the rows are retrieved
         - 1: single number, single index
         - 1-4: indexes from 1 to 4, included
@@ -110,54 +506,51 @@ def get_df_rows(df, rindex=None):
         - tail-N: last N rows
         - first: acronym for head-1
         - last: acronym for tail-1
-    :return: a list containing one dict per each row (the dict's keys are the column names, its values the row values)
-    """
-    data = []
-    if rindex is None:
-        data = []
-        for index, row in df.iterrows():
-            data.append({k: v for k, v in row.items()})
-    elif isinstance(rindex, int):
-        data = []
-        for index, row in df.iterrows():
-            if index == rindex:
-                # data.append({k: v for k, v in row.items()})
-                return {k: v for k, v in row.items()}
-    else:
-        rindex = str(rindex)
-        if rindex == 'first':
-            return get_df_rows(df, df.first_valid_index())
-        elif rindex == 'last':
-            return get_df_rows(df, df.last_valid_index())
-        elif re.fullmatch('head-[0-9]+', rindex):
-            rindex = range(df.first_valid_index(), int(rindex.split('-')[1]))
-        elif re.fullmatch('tail-[0-9]+', rindex):
-            rindex = range(df.last_valid_index() + 1 - int(rindex.split('-')[1]), df.last_valid_index() + 1)
-        elif re.fullmatch('[0-9]+-[0-9]+', rindex):
-            rindex = range(int(rindex.split('-')[0]), int(rindex.split('-')[1]) + 1)
-        elif re.fullmatch('([0-9](-[0-9]+)?,)*[0-9]+(-[0-9]+)?', rindex):
-            # rindex = [int(i) for i in rindex.split(',')]
-            aux = []
-            for i in rindex.split(','):
-                try:
-                    aux.append(int(i))
-                except ValueError:
-                    aux.extend(range(int(i.split('-')[0]), int(i.split('-')[1]) + 1))
-            rindex = aux
-        else:
-            raise ValueError("Unexpected value for parameter 'rindex'")
+    :param as_frame: If True, the selected rows are returned as a DataFrame (a view of `df` whenever pandas allows it)
+        instead of a list of dicts
+    :return: a list containing one dict per each row (the dict's keys are the column names, its values the row values).
+        Single row selectors (int, 'first', 'last') return the dict itself, or an empty list if the row does not exist
+    """
+    selector = compile_rindex(rindex)
+    rows = _select_rows(df, selector)
+    if as_frame:
+        return rows
+    records = rows.to_dict('records')
+    if selector.kind in ['label', 'first', 'last']:
+        return records[0] if len(records) > 0 else []
+    return records
+
 
-        for index, row in df.iterrows():
-            if index in rindex:
-                data.append({k: v for k, v in row.items()})
-    return data
+def iter_df_rows(df, rindex=None, batch_size=None, chunk_size=10000):
+    """
+    Generator version of `get_df_rows`. The selected rows are converted to dicts chunk by chunk,
+    so only ``chunk_size`` rows (or one batch) are materialized at any time.
+
+    :param df: Pandas dataframe to be scrapped
+    :param rindex: Index of the rows to retrieve. Same grammar as `get_df_rows`
+    :param batch_size: If None (default), the rows are yielded one by one. Otherwise, lists of up to
+        ``batch_size`` row dicts are yielded
+    :param chunk_size: Number of rows converted at once when yielding single rows
+    :return: A generator of row dicts, or of lists of row dicts if ``batch_size`` is set
+    """
+    if batch_size is not None and (not isinstance(batch_size, int) or batch_size < 1):
+        raise ValueError("Unexpected value for parameter 'batch_size'. Only positive integer numbers allowed")
+    rows = _select_rows(df, compile_rindex(rindex))
+    step = batch_size if batch_size is not None else max(int(chunk_size), 1)
+    for offset in range(0, len(rows), step):
+        records = rows.iloc[offset:offset + step].to_dict('records')
+        if batch_size is not None:
+            yield records
+        else:
+            yield from records
 
 
 def df_add_column(dataframe, col, on, how='left') -> pd.DataFrame:
     return dataframe.merge(col, on=on, how=how)
 
 
-def df_to_excel(output_file, contents: Union[dict, pd.DataFrame]) -> None:
+def df_to_excel(output_file, contents: Union[dict, pd.DataFrame], engine=None, streaming=False,
+                chunk_size=10000) -> None:
     """
     Saves the contents of a dataframe into an Excel file.
 
@@ -172,23 +565,172 @@ def df_to_excel(output_file, contents: Union[dict, pd.DataFrame]) -> None:
     :param output_file: name for the Excel file
     :param contents: single DataFrame or a dictionary,
         whose keys are page names, and its values the corresponding dataframe
+    :param engine: Engine used by `pandas.ExcelWriter`. By default, the pandas default for xlsx files
+    :param streaming: If True, the rows are written in chunks by an openpyxl write-only workbook,
+        which keeps the memory usage constant regardless of the size of the dataframes.
+        Cell styles (e.g. bold headers) are not applied in this mode
+    :param chunk_size: Number of rows converted at once when ``streaming`` is enabled
     :return: None
     """
-    if isinstance(contents, dict):
-        with pd.ExcelWriter(f"{output_file}.xlsx") as writer:
+    if isinstance(contents, pd.DataFrame):
+        contents = {'Sheet1': contents}
+    elif not isinstance(contents, dict):
+        raise TypeError("Invalid type for paramterer 'mapping'. Expected: dict|DataFrame")
+    if streaming:
+        _stream_to_excel(f"{output_file}.xlsx", contents, chunk_size)
+    else:
+        with pd.ExcelWriter(f"{output_file}.xlsx", engine=engine) as writer:
             for sheet_name, dataframe in contents.items():
                 dataframe.to_excel(writer, sheet_name=str(sheet_name), index=False, header=True)
-    elif isinstance(contents, pd.DataFrame):
-        with pd.ExcelWriter(f"{output_file}.xlsx") as writer:
-            contents.to_excel(writer, index=False, header=True)
+
+
+def _stream_to_excel(path, contents: dict, chunk_size=10000) -> None:
+    from openpyxl import Workbook
+    book = Workbook(write_only=True)
+    for sheet_name, dataframe in contents.items():
+        sheet = book.create_sheet(title=str(sheet_name))
+        sheet.append([str(c) for c in dataframe.columns])
+        for offset in range(0, len(dataframe), chunk_size):
+            chunk = dataframe.iloc[offset:offset + chunk_size]
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            for row in chunk.itertuples(index=False, name=None):
+                sheet.append(row)
+    book.save(path)
+
+
+MergePlan = collections.namedtuple('MergePlan', ['order', 'how', 'on', 'stats', 'keys', 'names'])
+"""
+Merge strategy chosen by `plan_merge`.
+
+- order: positions (within the input list) of the dataframes, in the order they will be merged
+- how: type of merge
+- on: list of columns on which the merge is applied
+- stats: per dataframe estimates (input order). Dicts with keys 'rows', 'keys', 'fanout' and 'estimated_rows'
+- keys: for inner merges, the join keys present in every dataframe, used to pre-filter them. None otherwise
+- names: names of the merged dataframes (e.g. page names), in plan order. None if not provided
+"""
+
+
+def _check_mergeable(dataframes):
+    if not isinstance(dataframes, list):
+        raise TypeError("Invalid type for parameter 'dataframes'. Allowed: list")
+    elif len(dataframes) < 2:
+        raise IndexError("Not enough dataframes to merge. At least 2 dataframes are required")
+
+
+def _join_keys(df, on: list) -> pd.Index:
+    if len(on) == 1:
+        return pd.Index(df[on[0]].unique())
+    return pd.MultiIndex.from_frame(df[on].drop_duplicates())
+
+
+def _filter_join_keys(df, on: list, keys: pd.Index) -> pd.DataFrame:
+    if len(on) == 1:
+        return df[df[on[0]].isin(keys)]
+    return df[pd.MultiIndex.from_frame(df[on]).isin(keys)]
+
+
+def _disjoint_columns(dataframes, on: list) -> bool:
+    # Overlapping non-key columns get suffixes depending on the merge order
+    seen = set()
+    for df in dataframes:
+        cols = set(df.columns) - set(on)
+        if not seen.isdisjoint(cols):
+            return False
+        seen.update(cols)
+    return True
+
+
+def plan_merge(dataframes: list, on: Union[str, list], how="inner", names=None) -> MergePlan:
+    """
+    Estimates the row count and key cardinality of every dataframe, and chooses the order in which
+    `multi_merge` should merge them, so the intermediate results are kept as small as possible.
+
+    - inner: the dataframes are pre-filtered to the keys present in all of them, and merged from the
+      smallest (estimated) to the largest
+    - outer: merged from the smallest to the largest
+    - left: the first dataframe stays as the base, the rest are merged from the lowest to the highest fan-out
+    - right (or any other): the original order is kept
+
+    The original order is kept as well if the dataframes share non-key columns,
+    since pandas would name the overlapping columns depending on the merge order.
+
+    :param dataframes: Set of dataframes to be merged
+    :param on: Column(s) to be merged
+    :param how: How to do the merge
+    :param names: (Optional) names of the dataframes, e.g. their page names within a `DataFrameCollection`
+    :return: A `MergePlan` that can be passed to `multi_merge`
+    """
+    _check_mergeable(dataframes)
+    on = _klists.list_wrap(on)
+    keys = [_join_keys(df, on) for df in dataframes]
+    common = reduce(lambda left, right: left.intersection(right), keys) if how == 'inner' else None
+    stats = []
+    for df, dfkeys in zip(dataframes, keys):
+        fanout = len(df) / len(dfkeys) if len(dfkeys) > 0 else 0.0
+        stats.append({'rows': len(df), 'keys': len(dfkeys), 'fanout': fanout,
+                      'estimated_rows': fanout * len(common) if common is not None else len(df)})
+    order = list(range(len(dataframes)))
+    if _disjoint_columns(dataframes, on):
+        if how in ['inner', 'outer']:
+            order.sort(key=lambda i: stats[i]['estimated_rows'])
+        elif how == 'left':
+            order = [0] + sorted(order[1:], key=lambda i: stats[i]['fanout'])
+    plan_names = [names[i] for i in order] if names is not None else None
+    return MergePlan(order, how, on, stats, common, plan_names)
+
+
+def _align_categorical_keys(dataframes, on: list) -> list:
+    # pandas only keeps the categorical dtype of a merge key if the categories are the same in both sides
+    for col in on:
+        if not all(isinstance(df[col].dtype, pd.CategoricalDtype) for df in dataframes):
+            continue
+        categories = pd.api.types.union_categoricals([df[col] for df in dataframes], ignore_order=True).categories
+        dataframes = [df if df[col].cat.categories.equals(categories) else
+                      df.assign(**{col: df[col].cat.set_categories(categories)}) for df in dataframes]
+    return dataframes
+
+
+def _merged_columns(dataframes, on: list) -> list:
+    # Column order produced by merging the dataframes sequentially
+    columns = list(dataframes[0].columns)
+    for df in dataframes[1:]:
+        columns.extend([c for c in df.columns if c not in on])
+    return columns
+
+
+def _index_merge(dataframes, on: list, how) -> Optional[pd.DataFrame]:
+    if how not in ['inner', 'outer', 'left']:
+        raise ValueError(f"Unsupported merge type for strategy 'index': '{how}'. Allowed: inner|outer|left")
+    elif not _disjoint_columns(dataframes, on):
+        return None
+    frames = [df.set_index(on) for df in dataframes]
+    if not all(f.index.is_unique for f in frames):
+        return None
+    if how == 'left':
+        merged = pd.concat([frames[0]] + [f.reindex(frames[0].index) for f in frames[1:]], axis=1)
     else:
-        raise TypeError("Invalid type for paramterer 'mapping'. Expected: dict|DataFrame")
+        merged = pd.concat(frames, axis=1, join=how, sort=how == 'outer')
+    return merged.reset_index()[_merged_columns(dataframes, on)]
 
 
-def multi_merge(dataframes: list, on: Union[str, list], how="inner", **kwargs):
+def multi_merge(dataframes: list, on: Union[str, list], how="inner", plan=None, strategy='reduce', **kwargs):
     """
     Merges multiple dataframes sequentially, starting by the first df in the list.
 
+    If a `plan` is used, the dataframes are merged in the order chosen by `plan_merge` instead
+    (the column order of the result is preserved, but the row order of inner merges may differ).
+
+    With ``strategy='index'`` the join keys are set as the index of every dataframe once, and all of them
+    are joined in a single `pandas.concat` instead of re-hashing the intermediate result on every merge.
+    It supports inner, outer and left merges, and gives the same result as the sequential merge. It falls back to
+    the sequential merge if the dataframes share non-key columns (they need suffixes), if the join keys are not
+    unique within every dataframe, or if `kwargs` are provided (e.g. ``suffixes``, ``indicator`` or ``validate``).
+    `plan` is ignored by this strategy.
+
+    Categorical merge keys (e.g. from `compact_dtypes`) are aligned to the union of their categories,
+    so the result keeps the categorical dtype. Other compact dtypes are kept as long as no NaN is introduced.
+
     **Warning**
 
     If a merged column contains a NaN, all the **integer** values in that column will
@@ -198,29 +740,137 @@ def multi_merge(dataframes: list, on: Union[str, list], how="inner", **kwargs):
     :param dataframes: Set of dataframes to be merged
     :param on: Column to be merged
     :param how: How to do the merge
+    :param plan: None (default) to merge in the given order. True to compute a `plan_merge`,
+        or an already computed `MergePlan`. A `ValueError` is raised if the plan was computed for
+        a different ``how``, ``on`` or number of dataframes
+    :param strategy: 'reduce' (default) to merge the dataframes one by one with `pandas.merge`.
+        'index' to join all of them at once on their index
     :param kwargs: Additional arguments to be passed to panda.merge()
     :return: A new dataframe with all the df from `dataframes` merged
     """
-    if not isinstance(dataframes, list):
-        raise TypeError("Invalid type for parameter 'dataframes'. Allowed: list")
-    elif len(dataframes) < 2:
-        raise IndexError("Not enough dataframes to merge. At least 2 dataframes are required")
-    else:
+    _check_mergeable(dataframes)
+    dataframes = _align_categorical_keys(dataframes, _klists.list_wrap(on))
+    if strategy == 'index':
+        merged = _index_merge(dataframes, _klists.list_wrap(on), how) if len(kwargs) == 0 else None
+        if merged is not None:
+            return merged
+        return reduce(lambda left, right: pd.merge(left, right, on=on, how=how, **kwargs), dataframes)
+    elif strategy != 'reduce':
+        raise ValueError(f"Unexpected value for parameter 'strategy': '{strategy}'. Allowed: reduce|index")
+    if plan is None or plan is False:
         return reduce(lambda left, right: pd.merge(left, right, on=on, how=how, **kwargs), dataframes)
+    elif plan is True:
+        plan = plan_merge(dataframes, on=on, how=how)
+    elif plan.how != how or plan.on != _klists.list_wrap(on) or len(plan.order) != len(dataframes):
+        raise ValueError(f"The merge plan (how='{plan.how}', on={plan.on}, {len(plan.order)} dataframes) does not "
+                         f"match the merge (how='{how}', on={_klists.list_wrap(on)}, {len(dataframes)} dataframes)")
+    frames = [dataframes[i] for i in plan.order]
+    if plan.keys is not None:
+        frames = [_filter_join_keys(df, plan.on, plan.keys) for df in frames]
+    merged = reduce(lambda left, right: pd.merge(left, right, on=on, how=how, **kwargs), frames)
+    if plan.order != sorted(plan.order):
+        merged = merged[_merged_columns(dataframes, plan.on)]
+    return merged
+
+
+def compact_dtypes(dataframe, category_threshold=0.5, floats=False) -> pd.DataFrame:
+    """
+    Reduces the memory usage of a dataframe by changing the dtype of its columns:
 
+    - integer columns are downcast to the smallest integer type that holds their values
+    - float columns are downcast to float32, only if ``floats`` is True (precision may be lost)
+    - string columns whose ratio of unique values is below ``category_threshold`` are converted to categoricals.
+      Columns holding unhashable values (dicts, lists...) are left unchanged
 
-def group_and_count(dataframe, group_by, count_colname='count'):
+    :param dataframe: Dataframe to be compacted
+    :param category_threshold: Maximum ratio (unique values / rows) for a string column to become a categorical
+    :param floats: Enable/disable the downcast of float columns
+    :return: A new dataframe with the compact dtypes
+    """
+    converted = {}
+    for col in dataframe.columns:
+        series = dataframe[col]
+        if pd.api.types.is_bool_dtype(series.dtype) or isinstance(series.dtype, pd.CategoricalDtype):
+            continue
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            converted[col] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_float_dtype(series.dtype) and floats:
+            converted[col] = pd.to_numeric(series, downcast='float')
+        elif (pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype)) and \
+                len(series) > 0:
+            try:
+                unique = series.nunique()
+            except TypeError:  # Unhashable values (e.g. dicts or lists) cannot be categorical
+                continue
+            if unique / len(series) < category_threshold:
+                converted[col] = series.astype('category')
+    if len(converted) == 0:
+        return dataframe
+    compact = dataframe.copy(deep=False)
+    for col, series in converted.items():
+        compact[col] = series
+    return compact
+
+
+def group_and_count(dataframe, group_by, count_colname='count', categorical=False):
     """
     Groups and count values in a given DataFrame, generating a new DataFrame with the results
 
     :param dataframe: (not empty) Dataframe containing the data to be count
     :param group_by: Columns (names) where the group by will be applied
     :param count_colname: New name for the column that contains the count. By default, 'count'
+    :param categorical: If True, string group keys are converted to categoricals first. Check `group_and_aggregate`
     :return: A new dataframe, with indexes reset to 0, and two columns: The group_by result and the count of each group
     """
-    if not isinstance(group_by, list):
-        group_by = [group_by]
-    return dataframe.groupby(group_by).size().reset_index(name=str(count_colname))
+    return group_and_aggregate(dataframe, group_by, count_colname=count_colname, categorical=categorical)
+
+
+def _as_categorical_keys(dataframe, group_by: list) -> pd.DataFrame:
+    converted = {}
+    for col in group_by:
+        dtype = dataframe[col].dtype
+        if not isinstance(dtype, pd.CategoricalDtype) and \
+                (pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype)):
+            converted[col] = dataframe[col].astype('category')
+    return dataframe.assign(**converted) if len(converted) > 0 else dataframe
+
+
+def group_and_aggregate(dataframe, group_by, aggregations: dict = None, count_colname='count', categorical=False):
+    """
+    Groups a given DataFrame and computes the size of each group, plus any number of aggregations,
+    over a single `groupby`. The grouping is computed once and shared by all the aggregations.
+
+    Example
+
+    - group_and_aggregate(df, 'ip', {'open_ports': ('port', 'nunique'), 'last_seen': ('date', 'max')})
+
+    :param dataframe: (not empty) Dataframe containing the data to be grouped
+    :param group_by: Columns (names) where the group by will be applied
+    :param aggregations: (Optional) named aggregations, as accepted by `DataFrameGroupBy.agg`:
+        new column name -> (column, aggregation function)
+    :param count_colname: New name for the column that contains the count. By default, 'count'.
+        If None, the count is not computed
+    :param categorical: If True, the string group keys are converted to categoricals before grouping.
+        The conversion is a full factorize pass, usually slower than grouping the strings directly, so it is
+        disabled by default. Keys that are already categorical (e.g. after `compact_dtypes`) are always grouped
+        with ``observed=True``, which is the fast path. The key columns of the result keep their original dtype
+    :return: A new dataframe, with indexes reset to 0: The group_by columns, the count and the aggregations
+    """
+    group_by = _klists.list_wrap(group_by)
+    frame = _as_categorical_keys(dataframe, group_by) if categorical else dataframe
+    grouped = frame.groupby(group_by, observed=True)
+    results = []
+    if count_colname is not None:
+        results.append(grouped.size().rename(str(count_colname)))
+    if aggregations:
+        results.append(grouped.agg(**aggregations))
+    if len(results) == 0:
+        raise ValueError("Nothing to compute. Provide 'aggregations' or a 'count_colname'")
+    result = pd.concat(results, axis=1).reset_index() if len(results) > 1 else results[0].reset_index()
+    for col in group_by:
+        if frame[col].dtype != dataframe[col].dtype:
+            result[col] = result[col].astype(dataframe[col].dtype)
+    return result
 
 
 if __name__ == '__main__':
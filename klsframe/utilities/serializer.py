@@ -1,27 +1,198 @@
+import copy
 import json
-from typing import Union
+import math
+import os
+from typing import Iterable, Iterator, Union
 import re
 import klsframe.protypes.kstrings as _kstr
 
+# YAML support is optional (PyYAML). The libyaml C loader/dumper are much faster, but they are not always available
+try:
+    import yaml
+    _YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    _YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+except ImportError:
+    yaml = None
+    _YAML_LOADER = _YAML_DUMPER = None
+_yaml_cache = {}  # Absolute path -> ((mtime, size), parsed object)
 
-def save_json(obj, filepath, indent=2) -> None:
+# Optional faster JSON backends. They are used if installed, falling back to the standard json module
+try:
+    import orjson as _fastjson
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    try:
+        import ujson as _fastjson
+        JSON_BACKEND = 'ujson'
+    except ImportError:
+        _fastjson = None
+        JSON_BACKEND = 'json'
+
+
+def _reject(obj):
+    # orjson `default`: objects json cannot encode (e.g. datetimes) are not encoded natively either
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _is_plain(obj) -> bool:
+    # True if the object only holds values every backend encodes like json: dicts, lists, tuples, str, int,
+    # finite floats, bool and None. orjson writes NaN/Infinity as null, and encodes UUIDs, enums, dates...
+    # natively, while json raises TypeError for them
+    pending = [obj]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            pending.extend(value)
+        elif isinstance(value, float):
+            if not math.isfinite(value):
+                return False
+        elif value is not None and not isinstance(value, (str, int)):
+            return False
+    return True
+
+
+def _dumps(obj, indent=None) -> str:
+    # The fast backends are only used for compact output (and orjson's 2 spaces indentation) of plain objects
+    # (see `_is_plain`), so the documents match json's (except non-ASCII text, written as UTF-8 instead of escaped).
+    # Anything else, and the objects they fail to encode (e.g. orjson and non-str keys), fall back to json
+    try:
+        if JSON_BACKEND == 'orjson' and indent in (None, 2) and _is_plain(obj):
+            option = _fastjson.OPT_PASSTHROUGH_DATETIME | _fastjson.OPT_PASSTHROUGH_DATACLASS
+            return _fastjson.dumps(obj, default=_reject,
+                                   option=option | _fastjson.OPT_INDENT_2 if indent else option).decode('utf-8')
+        elif JSON_BACKEND == 'ujson' and indent is None and _is_plain(obj):
+            return _fastjson.dumps(obj, escape_forward_slashes=False)
+    except (TypeError, OverflowError):
+        pass
+    return json.dumps(obj, indent=indent, separators=(',', ':') if indent is None else None)
+
+
+def _loads(contents: Union[str, bytes]):
+    if _fastjson is not None:
+        try:
+            return _fastjson.loads(contents)
+        except ValueError:
+            pass  # e.g. NaN/Infinity, which json accepts. Invalid documents raise json.JSONDecodeError below
+    return json.loads(contents)
+
+
+def save_json(obj, filepath, indent=None) -> None:
+    """
+    Saves an object as JSON, using the fastest backend available (see `JSON_BACKEND`)
+
+    :param obj: Object to be saved
+    :param filepath: Path of the output file
+    :param indent: Indentation of the output. By default, compact output (no whitespace)
+    :return: None
+    """
     if obj is not None and filepath is not None:
-        with open(filepath, 'w') as file:
-            json.dump(obj, file, indent=int(indent))
+        with open(filepath, 'w', encoding='utf-8') as file:
+            file.write(_dumps(obj, indent=None if indent is None else int(indent)))
 
 
 def load_json(filepath) -> Union[dict, list]:
     if filepath is not None:
-        with open(filepath, 'r') as file:
-            return json.load(file)
+        with open(filepath, 'rb') as file:
+            return _loads(file.read())
+
+
+def save_jsonl(records: Iterable, filepath, append=False) -> int:
+    """
+    Saves a sequence of objects as JSON Lines (one compact JSON document per line). The records are
+    written as they are consumed, so generators are never held in memory
+
+    :param records: Iterable of JSON serializable objects
+    :param filepath: Path of the output file
+    :param append: If True, the records are appended to the end of the file, without rewriting it
+    :return: Number of records written
+    """
+    written = 0
+    with open(filepath, 'a' if append else 'w', encoding='utf-8') as file:
+        for record in records:
+            file.write(_dumps(record))
+            file.write('\n')
+            written += 1
+    return written
+
+
+def iter_jsonl(filepath) -> Iterator:
+    """
+    Reads a JSON Lines file lazily. Blank lines are skipped
+
+    :param filepath: Path of the JSON Lines file
+    :return: A generator of the objects, one per line
+    """
+    with open(filepath, 'rb') as file:
+        for num, line in enumerate(file, start=1):
+            if line.strip():
+                try:
+                    yield _loads(line)
+                except ValueError as e:
+                    raise ValueError(f"Invalid JSON in line {num} of '{filepath}': {e}") from None
+
+
+def load_jsonl(filepath) -> list:
+    """
+    :param filepath: Path of the JSON Lines file
+    :return: A list with the objects of the file. Use `iter_jsonl` to read large files
+    """
+    return list(iter_jsonl(filepath))
 
 
 def save_yaml(obj, filepath) -> int:
-    pass
+    """
+    Saves an object as YAML (block style, keys in insertion order), using the libyaml C dumper if available
+
+    :param obj: Object to be saved. Only standard YAML types are supported (dict, list, str, numbers...)
+    :param filepath: Path of the output file
+    :return: 0 on success. 1 if there was nothing to save
+    """
+    if obj is None or filepath is None:
+        return 1
+    with open(filepath, 'w', encoding='utf-8') as file:
+        _yaml().dump(obj, file, Dumper=_YAML_DUMPER, default_flow_style=False, sort_keys=False,
+                     allow_unicode=True)
+    _yaml_cache.pop(os.path.abspath(filepath), None)
+    return 0
+
+
+def load_yaml(filepath, use_cache=True) -> Union[dict, list]:
+    """
+    Loads a YAML file, using the libyaml C loader if available. Only standard YAML tags are supported (safe loader).
+
+    The parsed files are cached by path, modification time and size, so reading the same (unmodified)
+    file again does not parse it again. A copy of the cached object is returned, so it can be modified safely
+
+    :param filepath: Path of the YAML file
+    :param use_cache: If False, the file is always parsed
+    :return: The object stored in the file. None if the file is empty
+    """
+    if filepath is None:
+        return None
+    path = os.path.abspath(filepath)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _yaml_cache.get(path) if use_cache else None
+    if cached is not None and cached[0] == version:
+        return copy.deepcopy(cached[1])
+    with open(path, 'rb') as file:
+        obj = _yaml().load(file, Loader=_YAML_LOADER)
+    if use_cache:
+        _yaml_cache[path] = (version, obj)
+        return copy.deepcopy(obj)
+    return obj
+
+
+def clear_yaml_cache() -> None:
+    _yaml_cache.clear()
 
 
-def load_yaml(filepath) -> Union[dict, list]:
-    pass
+def _yaml():
+    if yaml is None:
+        raise ImportError("PyYAML is required to read and write YAML files (pip install pyyaml)")
+    return yaml
 
 
 def save_file(filename, dir='.', fullpath=None, ext=''):
@@ -1,46 +1,429 @@
-import base64
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
 import os
+import re
+import sys
+import tempfile
+import threading
 import time
+from functools import partial
 from typing import Optional
+from urllib.parse import urlparse
+from xml.etree import ElementTree
 
 import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from klsframe.workers.apiCache import CacheBackend, CacheEntry, FilesystemCache, has_validators, request_key
+from klsframe.workers.apiStats import RequestStatistics
 
 # By default, cache dir is located in $TEMP/scp-temp
-__root_dir__ = os.environ.get('TEMP')
+__root_dir__ = os.environ.get('TEMP', tempfile.gettempdir())
 __cache_dir__ = 'scp-temp'
+__cache_ttl__ = 7 * 24 * 3600  # Time to live (seconds) of the default cache entries
+__cache_max_bytes__ = 1024 ** 3  # Maximum size (bytes) of the default cache
+__default_cache__ = None
+__default_cache_lock__ = threading.Lock()
+
+
+def default_cache() -> CacheBackend:
+    """
+    :return: The cache used when no other is provided: a `FilesystemCache` located in $TEMP/scp-temp,
+        whose entries expire after 7 days, limited to 1 GiB
+    """
+    global __default_cache__
+    with __default_cache_lock__:
+        if __default_cache__ is None:
+            __default_cache__ = FilesystemCache(os.path.join(__root_dir__, __cache_dir__), ttl=__cache_ttl__,
+                                                max_bytes=__cache_max_bytes__)
+        return __default_cache__
+
+
+class _SingleFlight:
+    # Network requests in flight, by request key. Concurrent identical requests share the first one's result:
+    # the body and metadata of the response (see `_shared_response`), never the leader's `PageResult`
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def join(self, key) -> tuple:
+        """
+        :return: A tuple (future, leader). The leader must send the request and `finish` it,
+            the rest wait for the result of the future
+        """
+        with self._lock:
+            if key in self._calls:
+                return self._calls[key], False
+            future = self._calls[key] = concurrent.futures.Future()
+            future.set_running_or_notify_cancel()  # Waiters cannot cancel the request of the leader
+            return future, True
+
+    def finish(self, key, future, result=None, exception=None) -> None:
+        with self._lock:
+            self._calls.pop(key, None)
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+
+__in_flight__ = _SingleFlight()
+
+
+class RateLimiter:
+    """
+    Per-host token bucket limiting the rate of the network requests. It is thread-safe,
+    and can be shared by threads (`acquire`) and asyncio tasks (`acquire_async`).
+
+    The limiter adapts to the server responses (see `record`): after consecutive failures (429/5xx responses
+    or connection errors) the minimum interval between requests grows exponentially, starting in ``backoff``
+    seconds, up to ``max_backoff``. A successful response restores the configured rate
+
+    :param rate: Maximum requests per second to each host. If None (default), there is no limit while the
+        requests are successful
+    :param burst: Maximum number of requests sent at once to a host that has been idle
+    :param backoff: Interval (seconds) between requests after the first failure
+    :param max_backoff: Maximum interval (seconds) between requests after consecutive failures
+    """
+
+    def __init__(self, rate=None, burst=1, backoff=0.5, max_backoff=60.0):
+        self.rate = rate
+        self.burst = int(burst)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.consecutive_failures = 0
+        self._buckets = {}  # Host -> (tokens, timestamp)
+        self._lock = threading.Lock()
+
+    def interval(self) -> float:
+        """
+        :return: Current minimum interval (seconds) between requests to the same host
+        """
+        interval = 1.0 / self.rate if self.rate else 0.0
+        if self.consecutive_failures > 0:
+            interval = max(interval, min(self.backoff * 2 ** (self.consecutive_failures - 1), self.max_backoff))
+        return interval
+
+    def _reserve(self, host) -> float:
+        with self._lock:
+            interval = self.interval()
+            if interval <= 0:
+                return 0.0
+            now = time.monotonic()
+            tokens, last = self._buckets.get(host, (float(self.burst), now))
+            tokens = min(float(self.burst), tokens + (now - last) / interval) - 1
+            self._buckets[host] = (tokens, now)
+            return -tokens * interval if tokens < 0 else 0.0
+
+    def acquire(self, host) -> None:
+        """
+        Blocks until a request to ``host`` can be sent
+        """
+        wait = self._reserve(host)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, host) -> None:
+        """
+        Waits (without blocking the event loop) until a request to ``host`` can be sent
+        """
+        wait = self._reserve(host)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def record(self, status_code=None) -> None:
+        """
+        Updates the consecutive failures with the result of a network request
+
+        :param status_code: HTTP status of the response. None if the request failed (e.g. connection error)
+        :return: None
+        """
+        with self._lock:
+            if status_code is None or status_code == 429 or status_code >= 500:
+                self.consecutive_failures += 1
+            else:
+                self.consecutive_failures = 0
 
 
 class WebService:
-    def __init__(self, host):
+    """
+    Web service (host) exposing a set of `Endpoint`. Every WebService owns a pooled `requests.Session`,
+    so the TCP/TLS connections are reused across requests to the same host
+
+    :param host: Base url of the service (e.g. https://example.com/api/)
+    :param pool_size: Maximum number of connections kept alive in the pool
+    :param max_retries: Retries of failed connections and of 429/5xx responses. 0 disables the retries
+    :param backoff_factor: Backoff factor between retries (sleeps ``backoff_factor * 2 ** retry`` seconds)
+    :param keep_alive: If False, the connections are closed after each request
+    """
+
+    def __init__(self, host, pool_size=10, max_retries=3, backoff_factor=0.3, keep_alive=True):
         self.host = str(host)
-        self._endpoints = set()
+        self._endpoints = EndpointRegistry()
         self.verify = True
-        self.delay = 0.0
-        self.consecutive_failures = 0
-        self.statistics = {
-            'executionTime': 0,
-            'numOfRequests': 0,
-            'consumedBandwidth': 0
-        }
+        self.limiter = RateLimiter()  # Shared by every request to this service (see `delay`)
+        self.cache = None  # CacheBackend used by this service. If None, the `default_cache`
+        self.parser = 'html.parser'  # BeautifulSoup parser of the responses (e.g. 'lxml', much faster if installed)
+        self.stream = False  # If True, the response bodies are streamed to the cache instead of held in memory
+        self.revalidate = False  # If True, cached responses are revalidated with the server (see `do_request`)
+        self.offline = False  # If True, responses are only served from the cache. Misses raise a KeyError
+        self.headers = {}  # Headers sent in every request to this service
+        self.cookies = {}  # Cookies sent in every request to this service
+        self.pool_size = int(pool_size)
+        self.max_retries = int(max_retries)
+        self.backoff_factor = float(backoff_factor)
+        self.keep_alive = keep_alive
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.statistics = RequestStatistics()  # Metrics of every request to this service, by endpoint
+
+    @property
+    def delay(self) -> float:
+        """
+        Minimum seconds between network requests to the host (cache hits are not delayed). 0 means no limit
+        """
+        return 1.0 / self.limiter.rate if self.limiter.rate else 0.0
+
+    @delay.setter
+    def delay(self, value):
+        self.limiter.rate = 1.0 / float(value) if value and float(value) > 0 else None
+
+    @property
+    def consecutive_failures(self) -> int:
+        return self.limiter.consecutive_failures
+
+    @consecutive_failures.setter
+    def consecutive_failures(self, value):
+        self.limiter.consecutive_failures = int(value)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Pooled session of this service. It is created on first use, with the service ``headers`` and ``cookies``
+        """
+        with self._session_lock:
+            if self._session is None:
+                self._session = _pooled_session(self.pool_size, self.max_retries, self.backoff_factor)
+                self._session.headers.update(self.headers)
+                self._session.cookies.update(self.cookies)
+                if not self.keep_alive:
+                    self._session.headers['Connection'] = 'close'
+            return self._session
+
+    def close(self):
+        """
+        Closes the pooled connections. A new session is created if the service is used again
+        """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
 
     def list_endpoints(self):
-        print(self._endpoints)
+        print(list(self._endpoints))
 
-    def get_endpoint(self, endp):
-        for ep in self._endpoints:
-            if endp in [ep.route, ep.title]:
-                return ep
-        return None
+    def add_endpoint(self, endpoint):
+        """
+        Registers an endpoint of this service. See `EndpointRegistry.add`
 
-    def connect(self, endp):
-        endpoint = self.get_endpoint(endp).connect()
-        return do_request(f"{self.host}{endpoint.route}", delay=self.delay,
-                          ignore_cache=endpoint.ignore_cache, verify=self.verify, **endpoint.properties)
+        :param endpoint: `Endpoint` instance
+        :return: The endpoint
+        """
+        return self._endpoints.add(endpoint)
+
+    def remove_endpoint(self, endp, method=None):
+        self._endpoints.remove(endp, method)
+
+    def get_endpoint(self, endp, method=None):
+        """
+        :param endp: Title or route of the endpoint. A concrete route (e.g. 'products/42') matches the
+            endpoint registered with its template (e.g. 'products/{productId}')
+        :param method: HTTP method of the endpoint. If None (default), GET is preferred when the route
+            is registered with several methods
+        :return: The `Endpoint`, or None if unknown
+        """
+        resolved = self._endpoints.resolve(endp, method)
+        return None if resolved is None else resolved[0]
+
+    def _resolve(self, endp, params=None) -> tuple:
+        # Returns the endpoint and the route to request, with the template parameters replaced
+        if isinstance(endp, Endpoint):
+            endpoint, matched = endp, {}
+        else:
+            resolved = self._endpoints.resolve(endp)
+            if resolved is None:
+                raise KeyError(f"Unknown endpoint '{endp}'")
+            endpoint, matched = resolved
+        return endpoint, endpoint.expand(**dict(matched, **(params or {})))
+
+    def connect(self, endp, **params):
+        """
+        Requests an endpoint of this service
+
+        :param endp: `Endpoint` instance, or its title or route
+        :param params: Values of the route template parameters (e.g. productId=42 for 'products/{productId}')
+        :return: The `PageResult`, or None if the request was not successful
+        """
+        endpoint, route = self._resolve(endp, params)
+        return do_request(f"{self.host}{route}", ignore_cache=endpoint.ignore_cache, cache=self.cache,
+                          session=self.session, limiter=self.limiter, parser=self.parser, stream=self.stream,
+                          revalidate=self.revalidate, stats=self.statistics, label=endpoint.title or endpoint.route,
+                          offline=self.offline, verify=self.verify, **endpoint.properties)
+
+    async def fetch_many(self, endpoints, concurrency=10, per_host=None):
+        """
+        Requests many endpoints concurrently. The requests are sent by a thread pool through the pooled
+        `session`, sharing the cache with `do_request`. The network requests (not the cache hits)
+        wait for the service `limiter` without blocking the event loop
+
+        Example
+
+        - async for endpoint, page in service.fetch_many(['products', 'users'], concurrency=5): ...
+
+        :param endpoints: Endpoints to be requested: `Endpoint` instances, or their routes or titles.
+            Concrete routes of templated endpoints (e.g. 'products/42') are supported
+        :param concurrency: Maximum number of requests in flight
+        :param per_host: Maximum number of requests in flight to the same host. By default, ``concurrency``
+        :return: An async generator of tuples (endpoint, page), yielded as the requests complete.
+            The page is None if the request was not successful. In `offline` mode, the first cache miss
+            raises a KeyError
+        """
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(concurrency)
+        host_limits = collections.defaultdict(lambda: asyncio.Semaphore(per_host or concurrency))
+        cache = default_cache() if self.cache is None else self.cache
+        session = self.session
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+        async def fetch(endp):
+            endpoint, route = self._resolve(endp)
+            url = f"{self.host}{route}"
+            host = urlparse(url).netloc
+            kwargs = dict(endpoint.properties, verify=self.verify)
+            method = kwargs.pop('method', 'GET')
+            key = _request_key(url, method, kwargs)
+            label = endpoint.title or endpoint.route
+            # The host slot is taken first, so tasks waiting for a saturated host do not hold global slots
+            async with host_limits[host], limit:
+                start = time.perf_counter()
+                lookup = partial(_cache_lookup, cache, key, ignore_cache=endpoint.ignore_cache,
+                                 revalidate=self.revalidate, offline=self.offline)
+                fresh, stale = await loop.run_in_executor(pool, lookup)
+                if fresh is None and self.offline:
+                    raise KeyError(f"The request to '{url}' is not cached (offline mode)")
+                page = None if fresh is None else _cached_page(fresh, self.parser)
+                leader = True
+                try:
+                    if page is None:
+                        future, leader = __in_flight__.join((id(cache), key))
+                        if leader:
+                            try:
+                                await self.limiter.acquire_async(host)
+                                request = partial(_from_network, url, method, key, cache, session, self.limiter,
+                                                  parser=self.parser, stream=self.stream, stale=stale,
+                                                  stats=self.statistics, label=label, **kwargs)
+                                page = await loop.run_in_executor(pool, request)
+                            except BaseException as e:
+                                __in_flight__.finish((id(cache), key), future, exception=e)
+                                raise
+                            __in_flight__.finish((id(cache), key), future, _shared_response(page))
+                        else:
+                            page = _coalesced_page(await asyncio.wrap_future(future), self.parser, self.stream)
+                except requests.RequestException as e:
+                    print(f"[ERROR] Request to '{url}' failed: {e}")
+                finally:
+                    self.statistics.observe(label, time.perf_counter() - start,
+                                            _cache_result(fresh, page, endpoint.ignore_cache, leader))
+                return endpoint, page
+
+        tasks = [asyncio.ensure_future(fetch(endp)) for endp in endpoints]
+        try:
+            for completed in asyncio.as_completed(tasks):
+                yield await completed
+        finally:
+            for task in tasks:
+                task.cancel()
+            pool.shutdown(wait=False)
+
+    def cache_coverage(self, endpoints) -> dict:
+        """
+        Checks which endpoints are cached (expired entries included), without sending any request
+
+        :param endpoints: `Endpoint` instances, or their routes or titles
+        :return: A dict with the ``cached`` and ``missing`` endpoints, the ``coverage`` ratio, and the ``expired``
+            endpoints (cached, thus usable in `offline` mode, but to be requested again)
+        """
+        cache = default_cache() if self.cache is None else self.cache
+        report = {'cached': [], 'missing': [], 'expired': []}
+        for endp in endpoints:
+            endpoint, route = self._resolve(endp)
+            kwargs = dict(endpoint.properties, verify=self.verify)
+            key = _request_key(f"{self.host}{route}", kwargs.pop('method', 'GET'), kwargs)
+            report['cached' if key in cache else 'missing'].append(endp)
+            if key in cache and not cache.is_fresh(key):
+                report['expired'].append(endp)
+        total = len(report['cached']) + len(report['missing'])
+        report['coverage'] = len(report['cached']) / total if total else 1.0
+        return report
+
+    def warm_cache(self, endpoints, concurrency=10, per_host=None) -> dict:
+        """
+        Requests the endpoints that are not cached yet or have expired, in parallel (see `fetch_many`), so they can
+        be served later in `offline` mode. If `revalidate` is True, every endpoint is requested, so the cached
+        responses holding validators are revalidated with the server
+
+        :param endpoints: `Endpoint` instances, or their routes or titles
+        :param concurrency: Maximum number of requests in flight
+        :param per_host: Maximum number of requests in flight to the same host
+        :return: The `cache_coverage` after warming the cache (``missing`` are the failed endpoints),
+            plus the number of endpoints ``fetched``
+        """
+        async def fetch_all(pending):
+            return [res async for res in self.fetch_many(pending, concurrency=concurrency, per_host=per_host)]
+
+        endpoints = list(endpoints)
+        if self.revalidate:
+            pending = endpoints
+        else:
+            coverage = self.cache_coverage(endpoints)
+            pending = coverage['missing'] + coverage['expired']
+        results = asyncio.run(fetch_all(pending)) if pending else []
+        report = self.cache_coverage(endpoints)
+        report['fetched'] = sum(1 for _, page in results if page is not None)
+        return report
+
+
+def _pooled_session(pool_size=10, max_retries=3, backoff_factor=0.3) -> requests.Session:
+    retries = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504],
+                    raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 class Endpoint:
+    """
+    Endpoint of a `WebService`. The route may be a template with parameters between braces,
+    e.g. 'products/{productId}'. The template is compiled once, when the route is set (see `match` and `expand`)
+
+    :param route: Route of the endpoint, relative to the service host
+    :param method: HTTP method
+    """
     __HTTP_METHODS = ['GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT', 'OPTIONS', 'TRACE', 'PATCH']
+    __TEMPLATE_PARAM = re.compile(r'{(\w+)}')
 
     def __init__(self, route, method=__HTTP_METHODS[0]):
         # TODO: Wrapper for params
@@ -49,7 +432,7 @@ class Endpoint:
         # Opt 2. Structured data
         assert method in Endpoint.__HTTP_METHODS, f"Unknown method {method}"
         self.title = ''
-        self.route = str(route)
+        self.route = route
         self.ignore_cache = False
         self.properties = {'method': method}  # Any of requests.request() params (headers, cookies, ...)
 
@@ -59,35 +442,519 @@ class Endpoint:
     def __eq__(self, other):
         return isinstance(other, Endpoint) and self.__dict__ == other.__dict__
 
+    def __hash__(self):
+        return hash((self.properties.get('method'), self._route))
+
+    @property
+    def route(self) -> str:
+        return self._route
+
+    @route.setter
+    def route(self, value):
+        self._route = str(value)
+        self._params = tuple(Endpoint.__TEMPLATE_PARAM.findall(self._route))
+        self._matcher = None
+        if self._params:
+            parts = Endpoint.__TEMPLATE_PARAM.split(self._route)
+            # Odd parts are the parameter names. Parameters match a single path segment
+            self._matcher = re.compile(''.join(f"(?P<{part}>[^/?#]+)" if i % 2 else re.escape(part)
+                                               for i, part in enumerate(parts)) + '$')
+
+    @property
+    def params(self) -> tuple:
+        """
+        Names of the route template parameters. Empty if the route is not a template
+        """
+        return self._params
+
+    @property
+    def is_template(self) -> bool:
+        return bool(self._params)
+
+    def match(self, route) -> Optional[dict]:
+        """
+        :param route: Concrete route, e.g. 'products/42'
+        :return: The values of the template parameters, e.g. {'productId': '42'}, or None if the route does not match
+        """
+        if self._matcher is None:
+            return {} if route == self._route else None
+        matched = self._matcher.match(route)
+        return None if matched is None else matched.groupdict()
+
+    def expand(self, **params) -> str:
+        """
+        :param params: Values of the template parameters
+        :return: The route with the template parameters replaced
+        """
+        missing = [param for param in self._params if param not in params]
+        if missing:
+            raise KeyError(f"Missing route parameters {missing} of the endpoint '{self._route}'")
+        return self._route.format(**params) if self._params else self._route
+
     def request_template(self):
         return
 
 
-def do_request(url, method='GET', delay=0.0, ignore_cache=False, **kwargs) -> Optional[BeautifulSoup]:
-    # TODO: handle other types of files (json, xml, binaries ...)
-    __MAX_URL_LEN__ = 250
-    if len(url) > __MAX_URL_LEN__:
-        raise ValueError(f"Max url length exceeded ({len(url)} > {__MAX_URL_LEN__})")
+class EndpointRegistry:
+    """
+    Endpoints of a `WebService`, indexed by title and by method and route, so the same route can be registered
+    once per HTTP method. Routes are resolved in constant time, except the concrete routes of templated endpoints
+    (e.g. 'products/42' for 'products/{productId}'), which are matched against the templates with the same number
+    of path segments. If no method is given, the GET endpoint of the route is preferred
+    """
+
+    def __init__(self, endpoints=None):
+        self._by_title = {}
+        self._by_route = {}  # Route -> {method: endpoint}
+        self._templates = collections.defaultdict(list)  # Number of path segments -> templated endpoints
+        for endpoint in endpoints or []:
+            self.add(endpoint)
+
+    def __len__(self):
+        return sum(len(methods) for methods in self._by_route.values())
+
+    def __iter__(self):
+        return (endpoint for methods in self._by_route.values() for endpoint in methods.values())
+
+    def __contains__(self, endp):
+        if isinstance(endp, Endpoint):
+            return self.resolve(endp.route, _method(endp)) is not None
+        return self.resolve(endp) is not None
+
+    def __repr__(self):
+        return f"EndpointRegistry({list(self)})"
+
+    def add(self, endpoint: Endpoint) -> Endpoint:
+        """
+        Registers an endpoint, replacing the one with the same method and route, or the same title.
+        Changes to the route, method or title of a registered endpoint are not indexed: remove and add it again
+
+        :param endpoint: `Endpoint` instance
+        :return: The endpoint
+        """
+        if not isinstance(endpoint, Endpoint):
+            raise TypeError(f"'endpoint' must be an Endpoint, not '{type(endpoint).__name__}'")
+        same_route = self._by_route.get(endpoint.route, {}).get(_method(endpoint))
+        for previous in {same_route, self._by_title.get(endpoint.title)} - {None}:
+            self.remove(previous)
+        self._by_route.setdefault(endpoint.route, {})[_method(endpoint)] = endpoint
+        if endpoint.title:
+            self._by_title[endpoint.title] = endpoint
+        if endpoint.is_template:
+            self._templates[endpoint.route.count('/')].append(endpoint)
+        return endpoint
+
+    def remove(self, endp, method=None) -> None:
+        """
+        :param endp: `Endpoint` instance, or its title or route
+        :param method: HTTP method of the endpoint, if ``endp`` is a route registered with several methods
+        :return: None
+        """
+        if isinstance(endp, Endpoint):
+            endpoint = endp
+        elif endp in self._by_title:
+            endpoint = self._by_title[endp]
+        else:
+            methods = self._by_route.get(endp, {})
+            if method is None and len(methods) > 1:
+                raise KeyError(f"Endpoint '{endp}' is registered with several methods {list(methods)}")
+            endpoint = methods.get(method) if method is not None else next(iter(methods.values()), None)
+        if endpoint is None or self._by_route.get(endpoint.route, {}).get(_method(endpoint)) is not endpoint:
+            raise KeyError(f"Unknown endpoint '{endp}'")
+        methods = self._by_route[endpoint.route]
+        del methods[_method(endpoint)]
+        if not methods:
+            del self._by_route[endpoint.route]
+        if self._by_title.get(endpoint.title) is endpoint:
+            del self._by_title[endpoint.title]
+        if endpoint.is_template:
+            self._templates[endpoint.route.count('/')].remove(endpoint)
+
+    def resolve(self, endp, method=None) -> Optional[tuple]:
+        """
+        :param endp: Title or route of the endpoint
+        :param method: HTTP method of the endpoint. If None (default), GET is preferred when the route
+            is registered with several methods
+        :return: A tuple (endpoint, template parameters), or None if unknown
+        """
+        endpoint = self._by_title.get(endp)
+        if endpoint is not None:
+            return (endpoint, {}) if method is None or _method(endpoint) == method else None
+        endpoint = _pick_method(self._by_route.get(endp, {}), method)
+        if endpoint is not None:
+            return endpoint, {}
+        matches = {}
+        for endpoint in self._templates.get(str(endp).count('/'), []):
+            params = endpoint.match(endp)
+            if params is not None:
+                matches.setdefault(_method(endpoint), (endpoint, params))
+        return _pick_method(matches, method)
+
+
+def _method(endpoint: Endpoint) -> str:
+    return endpoint.properties.get('method')
+
+
+def _pick_method(methods: dict, method=None):
+    # Value registered for the method. Without a method, the GET one, or else the first registered
+    if method is not None:
+        return methods.get(method)
+    return methods.get('GET', next(iter(methods.values()), None))
+
+
+class PageResult:
+    """
+    Response returned by `do_request`. The body is kept as raw bytes, and it is only parsed when accessed:
+
+    - soup: `BeautifulSoup` of the body, built with the chosen parser
+    - json(): the body decoded as JSON
+    - xml: the body parsed as an `xml.etree.ElementTree.Element`
+    - data: the body parsed according to its content type (``kind``): soup, json, xml, or the raw bytes
+
+    Any other attribute is looked up in `soup`, so the result can be used as the `BeautifulSoup`
+    that `do_request` used to return (e.g. ``page.find('p')`` or ``page.text``, the text of the document).
+    The decoded body is available as `body_text`
+    """
+
+    def __init__(self, url, content: bytes = None, status_code=200, content_type='', encoding=None,
+                 parser='html.parser', from_cache=False, loader=None):
+        self.url = url
+        self.status_code = status_code
+        self.content_type = content_type or ''
+        self.encoding = encoding
+        self.parser = parser
+        self.from_cache = from_cache
+        self._content = content
+        self._loader = loader  # Reads the content on first access, used when the body was streamed
+        self._soup = None
+
+    def __repr__(self):
+        return f"PageResult({self.status_code} {self.url})"
+
+    def __str__(self):
+        return self.body_text
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.soup, name)
+
+    @property
+    def content(self) -> bytes:
+        if self._content is None and self._loader is not None:
+            self._content = self._loader()
+        return self._content if self._content is not None else b''
+
+    @property
+    def body_text(self) -> str:
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    @property
+    def kind(self) -> str:
+        """
+        :return: Type of the body, according to its content type: 'html', 'json', 'xml' or 'binary'
+        """
+        ctype = self.content_type.lower()
+        if 'json' in ctype:
+            return 'json'
+        elif 'xml' in ctype and 'html' not in ctype:
+            return 'xml'
+        elif ctype == '' or 'html' in ctype or ctype.startswith('text/'):
+            return 'html'
+        return 'binary'
+
+    @property
+    def soup(self) -> BeautifulSoup:
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.content, self.parser, from_encoding=self.encoding)
+        return self._soup
+
+    def json(self):
+        return json.loads(self.body_text)
+
+    @property
+    def xml(self) -> ElementTree.Element:
+        return ElementTree.fromstring(self.content)
+
+    @property
+    def data(self):
+        kind = self.kind
+        if kind == 'json':
+            return self.json()
+        elif kind == 'xml':
+            return self.xml
+        elif kind == 'html':
+            return self.soup
+        return self.content
+
+
+def do_request(url, method='GET', delay=0.0, ignore_cache=False, cache: CacheBackend = None,
+               session: requests.Session = None, limiter: RateLimiter = None, parser='html.parser', stream=False,
+               revalidate=False, stats: RequestStatistics = None, label=None, offline=False,
+               **kwargs) -> Optional[PageResult]:
+    """
+    Requests a web page, using the cache if possible. The raw body is cached, and it is only parsed
+    when the returned `PageResult` is accessed. HTML, JSON, XML and binary responses are supported.
+
+    Concurrent identical requests (same cache and request key) are coalesced: only the first one is sent,
+    and the rest wait for its response. Each request gets its own `PageResult`, built with its own ``parser``.
+
+    The ETag and Last-Modified headers of the responses are cached too. Expired entries (see `CacheBackend.ttl`),
+    and every entry if ``revalidate`` is True, are revalidated with a conditional request
+    (If-None-Match/If-Modified-Since): a 304 response refreshes the cached entry without downloading the body
+
+    :param url: Url to be requested
+    :param method: HTTP method
+    :param delay: Seconds to wait before the request (cache hits included). Prefer a ``limiter``
+    :param ignore_cache: If True, the cache is not read (the response is stored anyway)
+    :param cache: `CacheBackend` where the responses are cached. By default, the `default_cache`
+    :param session: (Optional) `requests.Session` used to send the request, e.g. `WebService.session`
+    :param limiter: (Optional) `RateLimiter` applied to the network requests, e.g. `WebService.limiter`
+    :param parser: Parser used to build the `PageResult.soup`: 'html.parser' (default), 'lxml', 'html5lib'...
+    :param stream: If True, the body is downloaded in chunks and written to the cache as it arrives, and to a
+        temporary file the returned `PageResult` reads it from when accessed. So it is never held in memory
+        until then, and it is still available if the cache evicts it (e.g. if it is larger than `max_bytes`)
+    :param revalidate: If True, cached entries holding validators are revalidated with the server before being used
+    :param stats: (Optional) `RequestStatistics` where the request is recorded, e.g. `WebService.statistics`
+    :param label: Endpoint under which the request is recorded in ``stats``. By default, the url path
+    :param offline: If True, the response is served from the cache only (expired entries included),
+        and a KeyError is raised if it is not cached. ``ignore_cache`` and ``revalidate`` are ignored
+    :param kwargs: Additional arguments for `requests.request`
+    :return: The `PageResult`, or None if the request was not successful
+    """
     time.sleep(delay)
-    enc = base64.b64encode(url.encode('utf-8')).decode('utf-8')
-    os.makedirs(os.path.join(__root_dir__, __cache_dir__), exist_ok=True)
-    path = os.path.join(__root_dir__, __cache_dir__, f"{enc}.html")
+    start = time.perf_counter()
+    cache = default_cache() if cache is None else cache
+    key = _request_key(url, method, kwargs)
+    label = (urlparse(url).path or url) if label is None else label
+    fresh, stale = _cache_lookup(cache, key, ignore_cache=ignore_cache, revalidate=revalidate, offline=offline)
+    if fresh is None and offline:
+        raise KeyError(f"The request to '{url}' is not cached (offline mode)")
+    page = None if fresh is None else _cached_page(fresh, parser)
+    leader = True
+    try:
+        if page is None:
+            # Concurrent identical requests are coalesced: only the first one is sent
+            future, leader = __in_flight__.join((id(cache), key))
+            if not leader:
+                page = _coalesced_page(future.result(), parser, stream)
+                return page
+            try:
+                if limiter is not None:
+                    limiter.acquire(urlparse(url).netloc)
+                page = _from_network(url, method, key, cache, session, limiter, parser=parser, stream=stream,
+                                     stale=stale, stats=stats, label=label, **kwargs)
+            except BaseException as e:
+                __in_flight__.finish((id(cache), key), future, exception=e)
+                raise
+            __in_flight__.finish((id(cache), key), future, _shared_response(page))
+        return page
+    finally:
+        if stats is not None:
+            stats.observe(label, time.perf_counter() - start, _cache_result(fresh, page, ignore_cache, leader))
+
+
+def _request_key(url, method, kwargs: dict) -> str:
+    return request_key(method, url, params=kwargs.get('params'), data=kwargs.get('data'),
+                       json_body=kwargs.get('json'), headers=kwargs.get('headers'))
+
+
+def _cache_lookup(cache: CacheBackend, key, ignore_cache=False, revalidate=False, offline=False) -> tuple:
+    # Returns (fresh entry to be used as is, stale entry to be revalidated). Offline, any cached entry is fresh
+    if offline:
+        return cache.get(key, expired=True), None
+    if ignore_cache:
+        return None, None
+    cached = cache.get(key)
+    if cached is not None and not (revalidate and has_validators(cached)):
+        return cached, None
+    stale = cached if cached is not None else cache.peek(key)
+    return None, stale if stale is not None and has_validators(stale) else None
 
-    # TRY CACHE
+
+def _cached_page(cached: CacheEntry, parser='html.parser') -> PageResult:
+    return PageResult(cached.metadata.get('url'), cached.value, status_code=cached.metadata.get('status', 200),
+                      content_type=cached.metadata.get('content_type'), encoding=cached.metadata.get('encoding'),
+                      parser=parser, from_cache=True)
+
+
+def _cache_result(fresh, page, ignore_cache=False, leader=True) -> str:
+    if fresh is not None:
+        return 'hit'
+    if not leader:
+        return 'coalesced'
+    if page is not None and page.from_cache:
+        return 'revalidated'
+    return 'bypass' if ignore_cache else 'miss'
+
+
+def _body_size(body) -> int:
+    # Size of a prepared request body. Streamed bodies (files, generators) are not counted
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    return len(body) if isinstance(body, bytes) else 0
+
+
+def _counted(chunks, counter: list):
+    # Counts the bytes of the streamed chunks in counter[0]
+    for chunk in chunks:
+        counter[0] += len(chunk)
+        yield chunk
+
+
+class _SpooledBody:
+    # Streamed response body, kept in a temporary file (deleted once no PageResult refers to it)
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._lock = threading.Lock()
+
+    def tee(self, chunks):
+        for chunk in chunks:
+            self._file.write(chunk)
+            yield chunk
+
+    def read(self) -> bytes:
+        with self._lock:
+            self._file.seek(0)
+            return self._file.read()
+
+
+def _shared_response(page: Optional[PageResult]) -> Optional[CacheEntry]:
+    # Body (None if it was streamed) and metadata of a response, shared with coalesced requests
+    if page is None:
+        return None
+    return CacheEntry(page._content, {'url': page.url, 'status': page.status_code, 'content_type': page.content_type,
+                                      'encoding': page.encoding, 'from_cache': page.from_cache,
+                                      'loader': page._loader}, None)
+
+
+def _coalesced_page(shared: Optional[CacheEntry], parser='html.parser', stream=False) -> Optional[PageResult]:
+    # Every coalesced request gets its own PageResult (thus its own soup), built with its own parser.
+    # Streamed bodies are read from the leader's temporary file
+    if shared is None:
+        return None
+    content = None if stream else shared.value
+    loader = None if content is not None else shared.metadata['loader'] or partial(getattr, shared, 'value')
+    return PageResult(shared.metadata['url'], content, status_code=shared.metadata['status'],
+                      content_type=shared.metadata['content_type'], encoding=shared.metadata['encoding'],
+                      parser=parser, from_cache=shared.metadata['from_cache'], loader=loader)
+
+
+def _from_network(url, method, key, cache: CacheBackend, session=None, limiter=None, parser='html.parser',
+                  stream=False, stale: CacheEntry = None, stats: RequestStatistics = None, label=None,
+                  **kwargs) -> Optional[PageResult]:
+    if stale is not None:
+        kwargs['headers'] = dict(kwargs.get('headers') or {})
+        if stale.metadata.get('etag'):
+            kwargs['headers']['If-None-Match'] = stale.metadata['etag']
+        if stale.metadata.get('last_modified'):
+            kwargs['headers']['If-Modified-Since'] = stale.metadata['last_modified']
     try:
-        if ignore_cache:
-            print(f"[DEBUG] Ignoring cache")
-            raise FileNotFoundError
-        with open(path, 'r', encoding='utf-8') as cached:
-            print(f"[DEBUG] Cache hit")
-            return BeautifulSoup(cached.read(), 'html.parser')
-    except FileNotFoundError:
-        print(f"[DEBUG] Cache miss")
-        _res = requests.request(method, url, **kwargs)
-        if _res.status_code not in range(100, 400):
-            print(f"[ERROR] Request not successful [{_res.status_code}]\n{_res.text}")
-            return None
-        _page = BeautifulSoup(_res.text, 'html.parser')
-        with open(path, 'w', encoding='utf-8') as dump:
-            dump.write(_page.prettify())
-        return _page
+        _res = (requests if session is None else session).request(method, url, stream=stream, **kwargs)
+    except requests.RequestException:
+        if limiter is not None:
+            limiter.record(None)
+        if stats is not None:
+            stats.record_response(label)
+        raise
+    if limiter is not None:
+        limiter.record(_res.status_code)
+    received = [0]
+    try:
+        with _res:
+            return _parse_response(_res, url, method, key, cache, parser, stream, stale, received)
+    finally:
+        if stats is not None:
+            retries = getattr(_res.raw, 'retries', None)
+            stats.record_response(label, _res.status_code, bytes_in=received[0],
+                                  bytes_out=_body_size(_res.request.body),
+                                  retries=len(retries.history) if retries is not None else 0)
+
+
+def _parse_response(_res: requests.Response, url, method, key, cache: CacheBackend, parser, stream, stale,
+                    received: list) -> Optional[PageResult]:
+    if _res.status_code == 304 and stale is not None:
+        metadata = dict(stale.metadata, etag=_res.headers.get('ETag', stale.metadata.get('etag')),
+                        last_modified=_res.headers.get('Last-Modified', stale.metadata.get('last_modified')))
+        cache.set(key, stale.value, **metadata)
+        return _cached_page(stale._replace(metadata=metadata), parser)
+    if _res.status_code not in range(100, 400):
+        received[0] = len(_res.content)
+        print(f"[ERROR] Request not successful [{_res.status_code}]\n{_res.text}")
+        return None
+    content_type = _res.headers.get('Content-Type', '')
+    charset = re.search('charset=([^;\\s]+)', content_type, flags=re.IGNORECASE)
+    metadata = {'url': url, 'method': method, 'status': _res.status_code, 'content_type': content_type,
+                'encoding': charset.group(1).strip('"\'') if charset is not None else None,
+                'etag': _res.headers.get('ETag'), 'last_modified': _res.headers.get('Last-Modified')}
+    if stream:
+        body = _SpooledBody()
+        cache.set_stream(key, body.tee(_counted(_res.iter_content(chunk_size=64 * 1024), received)), **metadata)
+        content, loader = None, body.read
+    else:
+        content, loader = _res.content, None
+        received[0] = len(content)
+        cache.set(key, content, **metadata)
+    return PageResult(url, content, status_code=_res.status_code, content_type=content_type,
+                      encoding=metadata['encoding'], parser=parser, loader=loader)
+
+
+def _read_routes(lines) -> list:
+    return [line.strip() for line in lines if line.strip() and not line.lstrip().startswith('#')]
+
+
+def main(argv=None) -> int:
+    """
+    Command line entry point (``klsframe-warm-cache``). Pre-warms the response cache of a web service
+    with a list of endpoints, requested in parallel, and reports the coverage of the cache.
+    With ``--check``, the coverage is reported without sending any request
+
+    :param argv: Command line arguments. By default, ``sys.argv[1:]``
+    :return: Exit code: 0 if every endpoint is cached, 1 otherwise
+    """
+    parser = argparse.ArgumentParser(
+        prog="klsframe-warm-cache",
+        description="Pre-warm the response cache of a web service, so it can be used in offline mode"
+    )
+    parser.add_argument('host', help="Base url of the service (e.g. https://example.com/api/)")
+    parser.add_argument('endpoints', nargs='*', help="Routes of the endpoints, relative to the host")
+    parser.add_argument('-f', '--file', help="File with one route per line ('-' for stdin). Lines starting "
+                                             "with '#' are ignored")
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help="Maximum number of requests in flight")
+    parser.add_argument('--cache-dir', help=f"Directory of the cache. By default, $TEMP/{__cache_dir__}")
+    parser.add_argument('--delay', type=float, default=0.0, help="Minimum seconds between requests to the host")
+    parser.add_argument('--max-retries', type=int, default=3, help="Retries of failed requests")
+    parser.add_argument('--revalidate', action='store_true',
+                        help="Revalidate the cached responses holding validators (ETag/Last-Modified)")
+    parser.add_argument('--check', action='store_true', help="Only report the coverage, without requests")
+    args = parser.parse_args(argv)
+
+    routes = list(args.endpoints)
+    if args.file == '-':  # stdin is not closed
+        routes.extend(_read_routes(sys.stdin))
+    elif args.file is not None:
+        with open(args.file, 'r', encoding='utf-8') as file:
+            routes.extend(_read_routes(file))
+    if not routes:
+        parser.error("no endpoints provided")
+    with WebService(args.host, pool_size=args.concurrency, max_retries=args.max_retries) as service:
+        if args.cache_dir is not None:
+            service.cache = FilesystemCache(args.cache_dir, ttl=__cache_ttl__, max_bytes=__cache_max_bytes__)
+        service.delay = args.delay
+        service.revalidate = args.revalidate
+        endpoints = [Endpoint(route) for route in routes]
+        if args.check:
+            report = service.cache_coverage(endpoints)
+        else:
+            report = service.warm_cache(endpoints, concurrency=args.concurrency)
+            print(f"[INFO] {report['fetched']} endpoints fetched")
+    for endpoint in report['missing']:
+        print(f"[WARN] Not cached: {endpoint.route}")
+    print(f"[{'OK' if not report['missing'] else 'WARN'}] Cache coverage: {len(report['cached'])}/{len(endpoints)} "
+          f"endpoints ({report['coverage']:.1%})")
+    return 0 if not report['missing'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,492 @@
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from typing import Iterable, Optional
+
+CacheEntry = collections.namedtuple('CacheEntry', ['value', 'metadata', 'stored_at'])
+"""
+Entry returned by a `CacheBackend`
+
+- value: cached contents (bytes)
+- metadata: dict with additional info about the entry (e.g. the url)
+- stored_at: timestamp (seconds since the epoch) of the moment the entry was stored
+"""
+
+
+_PURGE_INTERVAL = 60.0  # Maximum seconds between two sweeps of the expired entries (see `CacheBackend.purge_expired`)
+
+KEY_HEADERS = ['accept', 'accept-language', 'authorization', 'content-type']
+"""Request headers that make two requests to the same url different responses (thus, different cache entries)"""
+
+
+def request_key(method, url, params=None, data=None, json_body=None, headers=None, key_headers=None) -> str:
+    """
+    Computes the cache key of a request: a sha256 (hex) of the method, url, query params, body
+    and the relevant headers. Requests with a different method or body never share the same key
+
+    :param method: HTTP method
+    :param url: Requested url
+    :param params: Query params (as accepted by `requests.request`)
+    :param data: Request body (as accepted by `requests.request`)
+    :param json_body: JSON request body (the ``json`` argument of `requests.request`)
+    :param headers: Request headers
+    :param key_headers: Names of the headers included in the key. By default, `KEY_HEADERS`
+    :return: The hex digest identifying the request
+    """
+    key_headers = KEY_HEADERS if key_headers is None else [h.lower() for h in key_headers]
+    headers = {str(k).lower(): str(v) for k, v in (headers or {}).items() if str(k).lower() in key_headers}
+    if isinstance(params, dict):
+        params = sorted((str(k), str(v)) for k, v in params.items())
+    elif isinstance(params, (list, tuple)):
+        params = sorted((str(k), str(v)) for k, v in params)
+    if isinstance(data, dict):
+        data = sorted((str(k), str(v)) for k, v in data.items())
+    elif isinstance(data, bytes):
+        data = data.hex()
+    canonical = json.dumps([str(method).upper(), str(url), params, data, json_body, sorted(headers.items())],
+                           sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def has_validators(entry: CacheEntry) -> bool:
+    """
+    :param entry: Cache entry
+    :return: True if the entry stores HTTP validators (ETag or Last-Modified), thus it can be revalidated
+    """
+    return bool(entry.metadata.get('etag') or entry.metadata.get('last_modified'))
+
+
+class CacheBackend:
+    """
+    Base class of the response caches used by `APIworker.do_request`.
+
+    Subclasses implement the storage (`_read`, `_write`, `_delete`, `_contains`, `_stored_at`, `_usage`, `_oldest`,
+    `_expired`), while this class implements the expiration, the size limits and the hit/miss counters.
+    The least recently used entries are evicted first. Expired entries are deleted when they are read,
+    and swept periodically when new entries are stored (see `purge_expired`). Expired entries holding
+    HTTP validators (``etag`` or ``last_modified`` metadata) are kept for another ``stale_ttl`` seconds,
+    so they can be revalidated (see `peek`).
+
+    Backends holding resources (e.g. the `SQLiteCache` connection) release them on `close`.
+    They can be used as context managers as well.
+
+    :param ttl: Time to live (seconds) of the entries. If None (default), the entries never expire
+    :param stale_ttl: Seconds that expired entries holding HTTP validators are kept after their ``ttl``.
+        By default, one day. If None, they are kept until evicted by the size limits
+    :param max_entries: Maximum number of entries. If None (default), there is no limit
+    :param max_bytes: Maximum size (bytes) of the cached values. If None (default), there is no limit
+    :param compress: If True, the values are stored compressed (zlib). They are decompressed transparently
+    """
+
+    def __init__(self, ttl=None, max_entries=None, max_bytes=None, compress=False, stale_ttl=24 * 3600):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._next_purge = 0.0
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._contains(key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        pass
+
+    def peek(self, key) -> Optional[CacheEntry]:
+        """
+        Reads an entry without updating the counters nor its last access. Expired entries are returned as well
+
+        :param key: Key of the entry
+        :return: The `CacheEntry` stored under ``key``, or None if it does not exist
+        """
+        with self._lock:
+            return self._decode(self._read(key, touch=False))
+
+    def is_fresh(self, key) -> bool:
+        """
+        Checks an entry without reading its value, nor updating the counters or its last access
+
+        :param key: Key of the entry
+        :return: True if the entry exists and has not expired
+        """
+        with self._lock:
+            stored_at = self._stored_at(key)
+        return stored_at is not None and (self.ttl is None or time.time() - stored_at <= self.ttl)
+
+    def get(self, key, expired=False) -> Optional[CacheEntry]:
+        """
+        :param key: Key of the entry
+        :param expired: If True, expired entries are returned (and kept) as well
+        :return: The `CacheEntry` stored under ``key``, or None if it does not exist or has expired
+        """
+        with self._lock:
+            entry = self._read(key)
+            if entry is not None and not expired and self.ttl is not None and \
+                    time.time() - entry.stored_at > self.ttl:
+                if not has_validators(entry) or \
+                        (self.stale_ttl is not None and time.time() - entry.stored_at > self.ttl + self.stale_ttl):
+                    self._delete(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return self._decode(entry)
+
+    def set(self, key, value: bytes, **metadata) -> None:
+        """
+        Stores a value, evicting the least recently used entries if the size limits are exceeded
+
+        :param key: Key of the entry
+        :param value: Contents to be cached (bytes)
+        :param metadata: Additional info to be stored along with the value. It must be JSON serializable
+        :return: None
+        """
+        self.set_stream(key, [bytes(value)], **metadata)
+
+    def set_stream(self, key, chunks: Iterable[bytes], **metadata) -> None:
+        """
+        Same as `set`, but the value is provided in chunks (e.g. `requests.Response.iter_content`).
+        Backends storing data on disk write the chunks as they arrive, without joining them in memory
+
+        :param key: Key of the entry
+        :param chunks: Iterable of bytes
+        :param metadata: Additional info to be stored along with the value. It must be JSON serializable
+        :return: None
+        """
+        metadata.pop('compressed', None)
+        if self.compress:
+            metadata['compressed'] = True
+        self._write_stream(key, CacheEntry(None, metadata, time.time()), self._encode(chunks))
+        with self._lock:
+            if self.ttl is not None and time.monotonic() >= self._next_purge:
+                self.purge_expired()
+                self._next_purge = time.monotonic() + min(self.ttl, _PURGE_INTERVAL)
+            if self.max_entries is not None or self.max_bytes is not None:
+                entries, nbytes = self._usage()
+                while entries > 0 and ((self.max_entries is not None and entries > self.max_entries) or
+                                       (self.max_bytes is not None and nbytes > self.max_bytes)):
+                    self._delete(self._oldest())
+                    entries, nbytes = self._usage()
+
+    def _encode(self, chunks):
+        if not self.compress:
+            yield from chunks
+            return
+        compressor = zlib.compressobj()
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    @staticmethod
+    def _decode(entry: Optional[CacheEntry]) -> Optional[CacheEntry]:
+        if entry is not None and entry.metadata.get('compressed'):
+            metadata = {k: v for k, v in entry.metadata.items() if k != 'compressed'}
+            return entry._replace(value=zlib.decompress(entry.value), metadata=metadata)
+        return entry
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._delete(key)
+
+    def purge_expired(self) -> int:
+        """
+        Deletes the expired entries. Entries holding HTTP validators are deleted ``stale_ttl`` seconds later.
+        It is called periodically by `set`, so expired entries do not pile up
+
+        :return: Number of entries deleted
+        """
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            now = time.time()
+            expired = self._expired(now - self.ttl, None if self.stale_ttl is None else now - self.ttl - self.stale_ttl)
+            for key in expired:
+                self._delete(key)
+        return len(expired)
+
+    def stats(self) -> dict:
+        """
+        :return: A dict with the number of hits and misses, the hit ratio, and the entries and bytes stored
+        """
+        with self._lock:
+            entries, nbytes = self._usage()
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hitRatio': self.hits / lookups if lookups > 0 else 0.0, 'entries': entries, 'bytes': nbytes}
+
+    def _read(self, key, touch=True) -> Optional[CacheEntry]:
+        raise NotImplementedError
+
+    def _write(self, key, entry: CacheEntry) -> None:
+        raise NotImplementedError
+
+    def _write_stream(self, key, entry: CacheEntry, chunks: Iterable[bytes]) -> None:
+        value = b''.join(chunks)
+        with self._lock:
+            self._write(key, entry._replace(value=value))
+
+    def _delete(self, key) -> None:
+        raise NotImplementedError
+
+    def _contains(self, key) -> bool:
+        raise NotImplementedError
+
+    def _stored_at(self, key) -> Optional[float]:
+        # Time the entry was stored at, or None if it does not exist
+        raise NotImplementedError
+
+    def _expired(self, stored_before, stale_before=None) -> list:
+        # Keys of the entries stored before ``stored_before`` without HTTP validators, plus the ones
+        # stored before ``stale_before`` (if not None)
+        raise NotImplementedError
+
+    @staticmethod
+    def _is_expired(stored_at, validators, stored_before, stale_before) -> bool:
+        return stored_at < stored_before and \
+            (not validators or (stale_before is not None and stored_at < stale_before))
+
+    def _usage(self) -> tuple:
+        raise NotImplementedError
+
+    def _oldest(self):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """
+    In-memory LRU cache. The entries are lost when the process ends
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+
+    def _read(self, key, touch=True):
+        entry = self._entries.get(key)
+        if entry is not None and touch:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _write(self, key, entry):
+        self._delete(key)
+        self._entries[key] = entry
+        self._bytes += len(entry.value)
+
+    def _delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.value)
+
+    def _contains(self, key):
+        return key in self._entries
+
+    def _stored_at(self, key):
+        entry = self._entries.get(key)
+        return None if entry is None else entry.stored_at
+
+    def _expired(self, stored_before, stale_before=None):
+        return [key for key, entry in self._entries.items()
+                if self._is_expired(entry.stored_at, has_validators(entry), stored_before, stale_before)]
+
+    def _usage(self):
+        return len(self._entries), self._bytes
+
+    def _oldest(self):
+        return next(iter(self._entries))
+
+
+class FilesystemCache(CacheBackend):
+    """
+    Cache stored as one file per entry within a directory. Each file contains a line with the metadata (JSON)
+    followed by the cached value. The access time of the entries is tracked with the file modification time.
+    The files are sharded in subdirectories named after the first characters of the key
+    (e.g. ``ab/cd/abcd1234.cache``), so directory lookups stay fast with large number of entries
+
+    :param root: Directory where the entries are stored. It is created if it does not exist
+    :param shard_depth: Levels of subdirectories (two characters of the key each). 0 disables the sharding
+    """
+    _EXT = '.cache'
+
+    def __init__(self, root, shard_depth=2, **kwargs):
+        super().__init__(**kwargs)
+        self.root = str(root)
+        self.shard_depth = int(shard_depth)
+        os.makedirs(self.root, exist_ok=True)
+        self._index = None  # Key -> (size, stored_at, validators), LRU order. Only built if there are limits or ttl
+        self._bytes = 0
+
+    def _path(self, key) -> str:
+        shards = [key[2 * i:2 * i + 2] for i in range(self.shard_depth) if len(key) > 2 * i]
+        return os.path.join(self.root, *shards, f"{key}{self._EXT}")
+
+    def _read(self, key, touch=True):
+        try:
+            with open(self._path(key), 'rb') as file:
+                metadata = json.loads(file.readline())
+                value = file.read()
+            if touch:
+                os.utime(self._path(key))
+        except FileNotFoundError:
+            return None
+        if touch and self._index is not None and key in self._index:
+            self._index.move_to_end(key)
+        return CacheEntry(value, metadata.get('metadata', {}), metadata.get('stored_at', 0.0))
+
+    def _write(self, key, entry):
+        self._write_stream(key, entry, [entry.value])
+
+    def _write_stream(self, key, entry, chunks):
+        # The entry is written to a temporary file, then renamed: readers never see a partially written entry,
+        # and concurrent writers of the same key do not interleave (the last rename wins)
+        header = json.dumps({'stored_at': entry.stored_at, 'metadata': entry.metadata}).encode('utf-8')
+        os.makedirs(os.path.dirname(self._path(key)), exist_ok=True)
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{key}.", suffix='.tmp', dir=os.path.dirname(self._path(key)))
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(header + b'\n')
+                for chunk in chunks:
+                    file.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with self._lock:
+            if self._index is not None:
+                self._bytes += size - self._index.pop(key, (0,))[0]
+                self._index[key] = (size, entry.stored_at, has_validators(entry))
+
+    def _delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+        if self._index is not None:
+            self._bytes -= self._index.pop(key, (0,))[0]
+
+    def _contains(self, key):
+        return os.path.isfile(self._path(key))
+
+    def _stored_at(self, key):
+        try:
+            with open(self._path(key), 'rb') as file:
+                return json.loads(file.readline()).get('stored_at', 0.0)
+        except FileNotFoundError:
+            return None
+
+    def _build_index(self):
+        found = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(self._EXT):
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        with open(path, 'rb') as file:
+                            header = file.readline()
+                        stat = os.stat(path)
+                    except FileNotFoundError:  # Deleted by another process
+                        continue
+                    info = json.loads(header)
+                    entry = CacheEntry(None, info.get('metadata', {}), info.get('stored_at', 0.0))
+                    found.append((stat.st_mtime, filename[:-len(self._EXT)],
+                                  (stat.st_size - len(header), entry.stored_at, has_validators(entry))))
+        self._index = collections.OrderedDict((key, info) for _, key, info in sorted(found))
+        self._bytes = sum(size for size, _, _ in self._index.values())
+
+    def _expired(self, stored_before, stale_before=None):
+        if self._index is None:
+            self._build_index()
+        return [key for key, (_, stored_at, validators) in self._index.items()
+                if self._is_expired(stored_at, validators, stored_before, stale_before)]
+
+    def _usage(self):
+        if self._index is None:
+            self._build_index()
+        return len(self._index), self._bytes
+
+    def _oldest(self):
+        if self._index is None:
+            self._build_index()
+        return next(iter(self._index))
+
+
+class SQLiteCache(CacheBackend):
+    """
+    Cache stored in a single SQLite database
+
+    :param path: Path to the database file. It is created if it does not exist. Use ':memory:' for a temporary db
+    """
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = str(path)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, metadata TEXT, "
+                           "stored_at REAL, accessed_at REAL, size INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_stored ON entries (stored_at)")
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _read(self, key, touch=True):
+        row = self._conn.execute("SELECT value, metadata, stored_at FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if touch:
+            self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return CacheEntry(bytes(row[0]), json.loads(row[1]), row[2])
+
+    def _write(self, key, entry):
+        self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                           (key, entry.value, json.dumps(entry.metadata), entry.stored_at, time.time(),
+                            len(entry.value)))
+        self._conn.commit()
+
+    def _delete(self, key):
+        self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._conn.commit()
+
+    def _contains(self, key):
+        return self._conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def _stored_at(self, key):
+        row = self._conn.execute("SELECT stored_at FROM entries WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def _expired(self, stored_before, stale_before=None):
+        rows = self._conn.execute("SELECT key, metadata, stored_at FROM entries WHERE stored_at < ?", (stored_before,))
+        return [key for key, metadata, stored_at in rows.fetchall()
+                if self._is_expired(stored_at, has_validators(CacheEntry(None, json.loads(metadata), stored_at)),
+                                    stored_before, stale_before)]
+
+    def _usage(self):
+        entries, nbytes = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return entries, nbytes
+
+    def _oldest(self):
+        return self._conn.execute("SELECT key FROM entries ORDER BY accessed_at LIMIT 1").fetchone()[0]
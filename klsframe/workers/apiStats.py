@@ -0,0 +1,178 @@
+import bisect
+import collections
+import json
+import threading
+from typing import Optional
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Results of the cache lookups: 'hit' (fresh entry), 'revalidated' (304 response), 'coalesced' (result shared
+# by an identical request in flight), 'miss' (body downloaded) and 'bypass' (cache ignored)
+CACHE_RESULTS = ('hit', 'revalidated', 'coalesced', 'miss', 'bypass')
+
+
+class RequestStatistics:
+    """
+    Thread-safe metrics of the requests sent to a web service, grouped by endpoint: latency histogram,
+    cache results, bytes received and sent, retries and status codes.
+
+    The metrics are exported as a dict (`to_dict`), JSON (`to_json`) or Prometheus text format (`to_prometheus`).
+    The keys `executionTime`, `numOfRequests` and `consumedBandwidth` can be read as ``statistics[key]``
+
+    :param buckets: Upper bounds (seconds) of the latency histogram buckets
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(float(b) for b in buckets))
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        return self.summary()[key]
+
+    def __repr__(self):
+        return f"RequestStatistics({self.summary()})"
+
+    def _endpoint(self, label) -> dict:
+        # Must be called with the lock held
+        if label not in self._endpoints:
+            self._endpoints[label] = {
+                'requests': 0,
+                'latencySum': 0.0,
+                'latencyBuckets': [0] * (len(self.buckets) + 1),  # Last one is +Inf
+                'cache': collections.Counter(),
+                'bytesIn': 0,
+                'bytesOut': 0,
+                'retries': 0,
+                'statusCodes': collections.Counter()
+            }
+        return self._endpoints[label]
+
+    def observe(self, label, seconds, cache_result=None) -> None:
+        """
+        Records a completed request (cache hits included)
+
+        :param label: Endpoint of the request
+        :param seconds: Latency of the request
+        :param cache_result: Result of the cache lookup. One of `CACHE_RESULTS`
+        :return: None
+        """
+        with self._lock:
+            stats = self._endpoint(label)
+            stats['requests'] += 1
+            stats['latencySum'] += seconds
+            stats['latencyBuckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+            if cache_result is not None:
+                stats['cache'][cache_result] += 1
+
+    def record_response(self, label, status_code=None, bytes_in=0, bytes_out=0, retries=0) -> None:
+        """
+        Records a network response
+
+        :param label: Endpoint of the request
+        :param status_code: HTTP status of the response. None if the request failed (e.g. connection error)
+        :param bytes_in: Bytes of the response body
+        :param bytes_out: Bytes of the request body
+        :param retries: Retries needed to get the response
+        :return: None
+        """
+        with self._lock:
+            stats = self._endpoint(label)
+            stats['statusCodes']['error' if status_code is None else str(status_code)] += 1
+            stats['bytesIn'] += bytes_in
+            stats['bytesOut'] += bytes_out
+            stats['retries'] += retries
+
+    def reset(self) -> None:
+        with self._lock:
+            self._endpoints = {}
+
+    def summary(self) -> dict:
+        """
+        :return: The totals of every endpoint: executionTime (seconds), numOfRequests, consumedBandwidth (bytes),
+            cacheHitRatio, retries and statusCodes
+        """
+        endpoints = self.to_dict()['endpoints'].values()
+        cache = sum((collections.Counter(ep['cache']) for ep in endpoints), collections.Counter())
+        return {
+            'executionTime': sum(ep['executionTime'] for ep in endpoints),
+            'numOfRequests': sum(ep['numOfRequests'] for ep in endpoints),
+            'consumedBandwidth': sum(ep['bytesIn'] + ep['bytesOut'] for ep in endpoints),
+            'cacheHitRatio': _hit_ratio(cache),
+            'retries': sum(ep['retries'] for ep in endpoints),
+            'statusCodes': dict(sum((collections.Counter(ep['statusCodes']) for ep in endpoints),
+                                    collections.Counter()))
+        }
+
+    def to_dict(self) -> dict:
+        """
+        :return: A snapshot of the metrics of each endpoint, as {'endpoints': {endpoint: metrics}}
+            (the latency histogram is cumulative, as in Prometheus)
+        """
+        with self._lock:
+            endpoints = {}
+            for label, stats in self._endpoints.items():
+                cumulative, histogram = 0, {}
+                for bound, count in zip(self.buckets + (float('inf'),), stats['latencyBuckets']):
+                    cumulative += count
+                    histogram['+Inf' if bound == float('inf') else str(bound)] = cumulative
+                endpoints[str(label)] = {
+                    'numOfRequests': stats['requests'],
+                    'executionTime': stats['latencySum'],
+                    'latencyHistogram': histogram,
+                    'cache': dict(stats['cache']),
+                    'cacheHitRatio': _hit_ratio(stats['cache']),
+                    'bytesIn': stats['bytesIn'],
+                    'bytesOut': stats['bytesOut'],
+                    'retries': stats['retries'],
+                    'statusCodes': dict(stats['statusCodes'])
+                }
+        return {'endpoints': endpoints}
+
+    def to_json(self, indent=None) -> str:
+        """
+        :param indent: Indentation of the JSON output. By default, compact
+        :return: The `summary` and the metrics of each endpoint, as a JSON string
+        """
+        return json.dumps(dict(self.summary(), **self.to_dict()), indent=indent)
+
+    def to_prometheus(self, prefix='klsframe_http') -> str:
+        """
+        :param prefix: Prefix of the metric names
+        :return: The metrics in Prometheus text exposition format
+        """
+        endpoints = self.to_dict()['endpoints']
+        lines = [f"# HELP {prefix}_request_duration_seconds Latency of the requests (cache hits included)",
+                 f"# TYPE {prefix}_request_duration_seconds histogram"]
+        for label, stats in endpoints.items():
+            endpoint = f'endpoint="{_escape(label)}"'
+            for bound, count in stats['latencyHistogram'].items():
+                lines.append(f'{prefix}_request_duration_seconds_bucket{{{endpoint},le="{bound}"}} {count}')
+            lines.append(f"{prefix}_request_duration_seconds_sum{{{endpoint}}} {stats['executionTime']}")
+            lines.append(f"{prefix}_request_duration_seconds_count{{{endpoint}}} {stats['numOfRequests']}")
+        counters = [('cache_requests_total', 'Requests by result of the cache lookup', 'cache', 'result'),
+                    ('responses_total', 'Network responses by status code', 'statusCodes', 'status'),
+                    ('received_bytes_total', 'Bytes of the response bodies', 'bytesIn', None),
+                    ('sent_bytes_total', 'Bytes of the request bodies', 'bytesOut', None),
+                    ('retries_total', 'Retries of failed requests', 'retries', None)]
+        for name, description, field, sublabel in counters:
+            lines.extend([f"# HELP {prefix}_{name} {description}", f"# TYPE {prefix}_{name} counter"])
+            for label, stats in endpoints.items():
+                endpoint = f'endpoint="{_escape(label)}"'
+                if sublabel is None:
+                    lines.append(f"{prefix}_{name}{{{endpoint}}} {stats[field]}")
+                else:
+                    for value, count in stats[field].items():
+                        lines.append(f'{prefix}_{name}{{{endpoint},{sublabel}="{_escape(value)}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _hit_ratio(cache: dict) -> Optional[float]:
+    # Ratio of the cache lookups answered without downloading the body. None if there were no lookups
+    served = cache.get('hit', 0) + cache.get('revalidated', 0) + cache.get('coalesced', 0)
+    lookups = served + cache.get('miss', 0)
+    return served / lookups if lookups else None
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
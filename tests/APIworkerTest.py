@@ -0,0 +1,398 @@
+import asyncio
+import concurrent.futures
+import http.server
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import klsframe.workers.APIworker as apiworker
+import klsframe.workers.apiCache as apiCache
+import klsframe.workers.apiStats as apiStats
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests_served = 0
+    bodies_served = 0
+    client_ports = set()
+
+    def do_GET(self):
+        _Handler.requests_served += 1
+        _Handler.client_ports.add(self.client_address[1])
+        if self.path.startswith('/etag') and self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.send_header('ETag', '"v1"')
+            self.end_headers()
+            return
+        _Handler.bodies_served += 1
+        if self.path.startswith('/slow'):
+            time.sleep(0.2)
+        status = 503 if self.path.startswith('/fail') else 200
+        if self.path.startswith('/json'):
+            body, content_type = json.dumps({'path': self.path}).encode('utf-8'), 'application/json'
+        elif self.path.startswith('/bin'):
+            body, content_type = bytes(range(256)) * 1024, 'application/octet-stream'
+        else:
+            body = f"<html><body><p>{self.path}</p></body></html>".encode('utf-8')
+            content_type = 'text/html; charset=utf-8'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path.startswith('/etag'):
+            self.send_header('ETag', '"v1"')
+            self.send_header('Last-Modified', 'Wed, 21 Oct 2015 07:28:00 GMT')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _start_server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_do_request_cache():
+    _test_error = f"[FAIL] `test_do_request_cache` failed"
+    server, host = _start_server()
+    try:
+        cache = apiCache.MemoryCache()
+        served = _Handler.requests_served
+        page = apiworker.do_request(f"{host}/products", cache=cache)
+        assert page.find('p').text.strip() == '/products', _test_error
+        page = apiworker.do_request(f"{host}/products", cache=cache)
+        assert page.find('p').text.strip() == '/products', _test_error
+        assert _Handler.requests_served == served + 1, _test_error
+        assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1, _test_error
+        apiworker.do_request(f"{host}/products", cache=cache, ignore_cache=True)
+        assert _Handler.requests_served == served + 2, _test_error
+    finally:
+        server.shutdown()
+    print(f"[OK] `test_do_request_cache` successful")
+
+
+def test_webservice_session():
+    _test_error = f"[FAIL] `test_webservice_session` failed"
+    server, host = _start_server()
+    try:
+        with apiworker.WebService(host, pool_size=2) as service:
+            service.headers = {'User-Agent': 'klsframe'}
+            assert service.session.headers['User-Agent'] == 'klsframe', _test_error
+            _Handler.client_ports.clear()
+            for i in range(5):
+                apiworker.do_request(f"{host}/item{i}", cache=apiCache.MemoryCache(), session=service.session)
+            assert len(_Handler.client_ports) == 1, _test_error
+        assert service._session is None, _test_error
+        try:
+            service.connect('unknown')
+        except KeyError as e:
+            assert str(e) == "\"Unknown endpoint 'unknown'\"", _test_error
+    finally:
+        server.shutdown()
+    print(f"[OK] `test_webservice_session` successful")
+
+
+def test_webservice_fetch_many():
+    _test_error = f"[FAIL] `test_webservice_fetch_many` failed"
+    server, host = _start_server()
+
+    async def collect(service, endpoints, **kwargs):
+        return [res async for res in service.fetch_many(endpoints, **kwargs)]
+
+    try:
+        with apiworker.WebService(f"{host}/") as service:
+            service.cache = apiCache.MemoryCache()
+            endpoints = [apiworker.Endpoint(f"page{i}") for i in range(20)]
+            results = asyncio.run(collect(service, endpoints, concurrency=5))
+            assert len(results) == 20, _test_error
+            assert sorted(page.find('p').text.strip() for _, page in results) == \
+                   sorted(f"/page{i}" for i in range(20)), _test_error
+            service.delay = 0.05
+            start = time.perf_counter()
+            asyncio.run(collect(service, endpoints[:5], concurrency=5))
+            assert time.perf_counter() - start < 0.2, _test_error  # Cache hits are not rate limited
+            assert service.cache.stats()['hits'] == 5, _test_error
+            start = time.perf_counter()
+            asyncio.run(collect(service, [apiworker.Endpoint(f"new{i}") for i in range(5)], concurrency=5))
+            assert time.perf_counter() - start >= 0.2, _test_error
+        with apiworker.WebService('http://') as service:  # Routes include the host, to request two hosts
+            service.cache = apiCache.MemoryCache()
+            port = host.rsplit(':', 1)[1]
+            slow = [apiworker.Endpoint(f"127.0.0.1:{port}/slow/host{i}") for i in range(4)]
+
+            async def first_idle_host():
+                start = time.perf_counter()
+                async for endpoint, _ in service.fetch_many(slow + [apiworker.Endpoint(f"localhost:{port}/idle")],
+                                                            concurrency=4, per_host=1):
+                    if endpoint.route.endswith('/idle'):
+                        return time.perf_counter() - start
+
+            assert asyncio.run(first_idle_host()) < 0.15, _test_error  # Not blocked by the saturated host
+    finally:
+        server.shutdown()
+    print(f"[OK] `test_webservice_fetch_many` successful")
+
+
+def test_rate_limiter():
+    _test_error = f"[FAIL] `test_rate_limiter` failed"
+    limiter = apiworker.RateLimiter(rate=20, burst=2)
+    start = time.perf_counter()
+    for _ in range(4):
+        limiter.acquire('host')
+    assert 0.09 <= time.perf_counter() - start < 0.2, _test_error
+    limiter.record(503)
+    limiter.record(429)
+    assert limiter.consecutive_failures == 2 and limiter.interval() == 1.0, _test_error
+    limiter.record(200)
+    assert limiter.consecutive_failures == 0 and limiter.interval() == 0.05, _test_error
+    service = apiworker.WebService('http://127.0.0.1')
+    service.delay = 0.5
+    assert service.limiter.rate == 2.0 and service.delay == 0.5, _test_error
+    service.consecutive_failures = 3
+    assert service.limiter.interval() == 2.0, _test_error
+    print(f"[OK] `test_rate_limiter` successful")
+
+
+def test_do_request_payloads():
+    _test_error = f"[FAIL] `test_do_request_payloads` failed"
+    server, host = _start_server()
+    try:
+        cache = apiCache.MemoryCache(compress=True)
+        page = apiworker.do_request(f"{host}/products", cache=cache)
+        assert page._soup is None and page.kind == 'html' and page.encoding == 'utf-8', _test_error
+        assert page.find('p').text == '/products' and page._soup is not None, _test_error
+        assert page.text.strip() == '/products' and page.body_text.startswith('<'), _test_error  # Soup text
+        cached = apiworker.do_request(f"{host}/products", cache=cache)
+        assert cached.from_cache and cached.content == page.content, _test_error
+        result = apiworker.do_request(f"{host}/json/1", cache=cache)
+        assert result.kind == 'json' and result.data == {'path': '/json/1'}, _test_error
+        binary = apiworker.do_request(f"{host}/bin", cache=cache, stream=True)
+        assert binary._content is None and binary.kind == 'binary', _test_error
+        assert binary.data == bytes(range(256)) * 1024, _test_error
+        assert cache.stats()['bytes'] < 10000, _test_error  # Compressed
+        small = apiCache.MemoryCache(max_bytes=1024)
+        binary = apiworker.do_request(f"{host}/bin", cache=small, stream=True)
+        assert small.stats()['entries'] == 0, _test_error  # Larger than the cache, evicted at once
+        assert binary.content == bytes(range(256)) * 1024, _test_error
+    finally:
+        server.shutdown()
+    print(f"[OK] `test_do_request_payloads` successful")
+
+
+def test_do_request_revalidate():
+    _test_error = f"[FAIL] `test_do_request_revalidate` failed"
+    server, host = _start_server()
+    try:
+        cache = apiCache.MemoryCache(ttl=0.05)
+        served, bodies = _Handler.requests_served, _Handler.bodies_served
+        page = apiworker.do_request(f"{host}/etag", cache=cache)
+        key = apiCache.request_key('GET', f"{host}/etag")
+        assert not page.from_cache and cache.peek(key).metadata['etag'] == '"v1"', _test_error
+        time.sleep(0.1)  # Expired, but kept to be revalidated
+        page = apiworker.do_request(f"{host}/etag", cache=cache)
+        assert page.from_cache and page.find('p').text == '/etag', _test_error
+        assert _Handler.requests_served == served + 2 and _Handler.bodies_served == bodies + 1, _test_error
+        cache.ttl = None
+        apiworker.do_request(f"{host}/etag", cache=cache)
+        assert _Handler.requests_served == served + 2, _test_error  # Refreshed by the 304 response
+        page = apiworker.do_request(f"{host}/etag", cache=cache, revalidate=True)
+        assert page.from_cache and page.status_code == 200, _test_error
+        assert _Handler.requests_served == served + 3 and _Handler.bodies_served == bodies + 1, _test_error
+    finally:
+        server.shutdown()
+    print(f"[OK] `test_do_request_revalidate` successful")
+
+
+def test_webservice_statistics():
+    _test_error = f"[FAIL] `test_webservice_statistics` failed"
+    server, host = _start_server()
+
+    async def collect(service, endpoints):
+        return [res async for res in service.fetch_many(endpoints)]
+
+    try:
+        with apiworker.WebService(f"{host}/", max_retries=1, backoff_factor=0) as service:
+            service.cache = apiCache.MemoryCache()
+            products = apiworker.Endpoint('products')
+            products.title = 'Products'
+            asyncio.run(collect(service, [products, apiworker.Endpoint('fail')]))
+            asyncio.run(collect(service, [products]))
+            stats = service.statistics.to_dict()['endpoints']
+            assert stats['Products']['numOfRequests'] == 2 and stats['fail']['retries'] == 1, _test_error
+            assert stats['Products']['statusCodes'] == {'200': 1}, _test_error
+            assert stats['fail']['statusCodes'] == {'503': 1}, _test_error
+            assert stats['Products']['cacheHitRatio'] == 0.5, _test_error
+            assert stats['Products']['latencyHistogram']['+Inf'] == 2, _test_error
+            page = apiworker.do_request(f"{host}/json", cache=service.cache, stats=service.statistics)
+            assert service.statistics.to_dict()['endpoints']['/json']['bytesIn'] == len(page.content), _test_error
+            assert service.statistics['numOfRequests'] == 4 and service.statistics['consumedBandwidth'] > 0, \
+                _test_error
+            assert json.loads(service.statistics.to_json())['endpoints']['fail']['cache'] == {'miss': 1}, \
+                _test_error
+            prometheus = service.statistics.to_prometheus()
+            assert 'klsframe_http_request_duration_seconds_count{endpoint="Products"} 2' in prometheus, _test_error
+            assert 'klsframe_http_responses_total{endpoint="fail",status="503"} 1' in prometheus, _test_error
+    finally:
+        server.shutdown()
+    print(f"[OK] `test_webservice_statistics` successful")
+
+
+def test_endpoint_registry():
+    _test_error = f"[FAIL] `test_endpoint_registry` failed"
+    server, host = _start_server()
+    try:
+        with apiworker.WebService(f"{host}/") as service:
+            service.cache = apiCache.MemoryCache()
+            product = apiworker.Endpoint('products/{productId}')
+            product.title = 'Product'
+            service.add_endpoint(product)
+            service.add_endpoint(apiworker.Endpoint('products'))
+            assert product.params == ('productId',) and product.match('products/42') == {'productId': '42'}, \
+                _test_error
+            assert product.match('products/42/reviews') is None and product.expand(productId=7) == 'products/7', \
+                _test_error
+            assert hash(product) == hash(apiworker.Endpoint('products/{productId}')), _test_error
+            assert service.get_endpoint('Product') is product and service.get_endpoint('products/42') is product, \
+                _test_error
+            assert service.get_endpoint('products').route == 'products', _test_error
+            assert service.get_endpoint('users/42') is None, _test_error
+            assert service.connect('products/42').find('p').text == '/products/42', _test_error
+            assert service.connect('Product', productId=5).find('p').text == '/products/5', _test_error
+            try:
+                service.connect('Product')
+                assert False, _test_error
+            except KeyError as e:
+                assert 'productId' in str(e), _test_error
+            service.remove_endpoint('Product')
+            assert service.get_endpoint('products/42') is None and len(service._endpoints) == 1, _test_error
+            create = service.add_endpoint(apiworker.Endpoint('products', 'POST'))  # Same route, another method
+            assert len(service._endpoints) == 2 and create in service._endpoints, _test_error
+            assert service.get_endpoint('products').properties['method'] == 'GET', _test_error
+            assert service.get_endpoint('products', method='POST') is create, _test_error
+            try:
+                service.remove_endpoint('products')
+                assert False, _test_error
+            except KeyError:
+                pass
+            service.remove_endpoint('products', method='GET')
+            assert service.get_endpoint('products') is create and len(service._endpoints) == 1, _test_error
+    finally:
+        server.shutdown()
+    print(f"[OK] `test_endpoint_registry` successful")
+
+
+def test_do_request_single_flight():
+    _test_error = f"[FAIL] `test_do_request_single_flight` failed"
+    server, host = _start_server()
+
+    async def collect(service, endpoints):
+        return [res async for res in service.fetch_many(endpoints)]
+
+    try:
+        cache = apiCache.MemoryCache()
+        stats = apiStats.RequestStatistics()
+        served = _Handler.requests_served
+        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as pool:
+            pages = list(pool.map(lambda _: apiworker.do_request(f"{host}/slow", cache=cache, stats=stats), range(5)))
+        assert _Handler.requests_served == served + 1, _test_error
+        assert all(page.find('p').text == '/slow' for page in pages), _test_error
+        served = _Handler.requests_served
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+            pages = list(pool.map(lambda i: apiworker.do_request(f"{host}/slow/x", cache=cache, stream=i % 2 == 1,
+                                                                 parser=['html.parser', 'html5lib'][i % 2]), range(4)))
+        assert _Handler.requests_served == served + 1 and len({id(page) for page in pages}) == 4, _test_error
+        pages[0].find('p').decompose()  # Soups are not shared
+        assert pages[0].find('p') is None and pages[2].find('p').text == '/slow/x', _test_error
+        assert [page.parser for page in pages] == ['html.parser', 'html5lib'] * 2, _test_error
+        assert all(page.content == pages[0].content for page in pages), _test_error
+        assert stats.to_dict()['endpoints']['/slow']['cache'] == {'miss': 1, 'coalesced': 4}, _test_error
+        served = _Handler.requests_served
+        with apiworker.WebService(f"{host}/") as service:
+            service.cache = cache
+            results = asyncio.run(collect(service, [apiworker.Endpoint('slow/2')] * 3))
+            assert len(results) == 3 and _Handler.requests_served == served + 1, _test_error
+            assert len({id(page) for _, page in results}) == 3, _test_error
+    finally:
+        server.shutdown()
+    print(f"[OK] `test_do_request_single_flight` successful")
+
+
+def test_offline_mode():
+    _test_error = f"[FAIL] `test_offline_mode` failed"
+    server, host = _start_server()
+
+    async def collect(service, endpoints):
+        return [res async for res in service.fetch_many(endpoints)]
+
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_dir = os.path.join(tmpdir, 'cache')
+            with open(os.path.join(tmpdir, 'endpoints.txt'), 'w') as file:
+                file.write('# Products\nproducts/1\nproducts/2\n\nfail\n')
+            served = _Handler.requests_served
+            code = apiworker.main([f"{host}/", 'products/3', '-f', os.path.join(tmpdir, 'endpoints.txt'),
+                                   '--cache-dir', cache_dir, '-c', '3', '--max-retries', '0'])
+            assert code == 1 and _Handler.requests_served == served + 4, _test_error  # 'fail' is not cached
+            served = _Handler.requests_served
+            assert apiworker.main([f"{host}/", 'products/1', 'etag/1', '--cache-dir', cache_dir]) == 0 and \
+                   _Handler.requests_served == served + 1, _test_error  # Fresh entries are not requested again
+            bodies = _Handler.bodies_served
+            assert apiworker.main([f"{host}/", 'products/1', 'etag/1', '--revalidate',
+                                   '--cache-dir', cache_dir]) == 0, _test_error
+            assert _Handler.requests_served == served + 2 and _Handler.bodies_served == bodies, _test_error  # 304
+            assert apiworker.main([f"{host}/", 'products/1', 'products/2', 'products/3', '--check',
+                                   '--cache-dir', cache_dir]) == 0, _test_error
+            stdin = sys.stdin
+            try:
+                sys.stdin = io.StringIO('products/1\n# Comment\nproducts/2\n')
+                assert apiworker.main([f"{host}/", '-f', '-', '--check', '--cache-dir', cache_dir]) == 0, \
+                    _test_error
+                assert not sys.stdin.closed, _test_error
+            finally:
+                sys.stdin = stdin
+            with apiworker.WebService(f"{host}/") as service:
+                service.cache = apiCache.FilesystemCache(cache_dir, ttl=0)
+                service.offline = True
+                served = _Handler.requests_served
+                assert service.connect(apiworker.Endpoint('products/1')).find('p').text == '/products/1', \
+                    _test_error  # Expired entries are served as well
+                endpoints = {route: apiworker.Endpoint(route) for route in ['products/2', 'products/3', 'fail']}
+                assert len(asyncio.run(collect(service, [endpoints['products/2'], endpoints['products/3']]))) == 2, \
+                    _test_error
+                try:
+                    asyncio.run(collect(service, [endpoints['products/2'], endpoints['fail']]))
+                    assert False, _test_error
+                except KeyError as e:
+                    assert 'offline mode' in str(e), _test_error
+                assert _Handler.requests_served == served, _test_error
+                assert service.cache_coverage(endpoints.values())['missing'] == [endpoints['fail']], _test_error
+                service.offline = False
+                service.cache = apiCache.FilesystemCache(cache_dir, ttl=0.5)
+                time.sleep(0.6)
+                assert service.cache_coverage([endpoints['products/2']])['expired'] == [endpoints['products/2']], \
+                    _test_error
+                report = service.warm_cache([endpoints['products/2']])  # Expired entries are requested again
+                assert report['fetched'] == 1 and _Handler.requests_served == served + 1, _test_error
+                assert report['expired'] == [] and report['missing'] == [], _test_error
+    finally:
+        server.shutdown()
+    print(f"[OK] `test_offline_mode` successful")
+
+
+if __name__ == '__main__':
+    test_rate_limiter()
+    test_do_request_cache()
+    test_webservice_session()
+    test_webservice_fetch_many()
+    test_do_request_payloads()
+    test_do_request_revalidate()
+    test_webservice_statistics()
+    test_endpoint_registry()
+    test_do_request_single_flight()
+    test_offline_mode()
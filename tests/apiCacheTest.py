@@ -0,0 +1,115 @@
+import os
+import sqlite3
+import tempfile
+import time
+
+import klsframe.workers.apiCache as apiCache
+
+
+def _check_backend(cache, _test_error):
+    assert cache.get('missing') is None, _test_error
+    cache.set('a', b'0123456789', url='http://a')
+    entry = cache.get('a')
+    assert entry.value == b'0123456789' and entry.metadata == {'url': 'http://a'}, _test_error
+    cache.set('b', b'0123456789')
+    cache.get('a')
+    cache.set('c', b'0123456789')  # Exceeds max_entries, 'b' is the least recently used
+    assert 'b' not in cache and 'a' in cache and 'c' in cache, _test_error
+    cache.set('d', b'0' * 25)  # Exceeds max_bytes
+    assert 'a' not in cache and 'c' not in cache and 'd' in cache, _test_error
+    stats = cache.stats()
+    assert stats['hits'] == 2 and stats['misses'] == 1 and stats['entries'] == 1, _test_error
+    cache.max_entries = None
+    cache.set('e', b'0', etag='"v1"')
+    cache.ttl = 0.05
+    assert cache.is_fresh('e') and not cache.is_fresh('missing'), _test_error
+    time.sleep(0.1)
+    assert not cache.is_fresh('e') and 'e' in cache, _test_error
+    assert cache.get('d') is None and cache.get('e') is None, _test_error
+    assert cache.peek('d') is None and cache.peek('e').metadata == {'etag': '"v1"'}, _test_error
+
+
+def test_cache_backends():
+    _test_error = f"[FAIL] `test_cache_backends` failed"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        backends = [apiCache.MemoryCache(max_entries=2, max_bytes=30),
+                    apiCache.FilesystemCache(os.path.join(tmpdir, 'fs'), max_entries=2, max_bytes=30),
+                    apiCache.SQLiteCache(os.path.join(tmpdir, 'cache.db'), max_entries=2, max_bytes=30)]
+        for cache in backends:
+            _check_backend(cache, _test_error)
+        for cache in backends:
+            cache.close()
+        with apiCache.SQLiteCache(os.path.join(tmpdir, 'cache.db')) as db:
+            db.set('a', b'0')
+        try:
+            db.get('a')
+            assert False, _test_error
+        except sqlite3.ProgrammingError:  # The connection is closed when leaving the block
+            pass
+        compressed = apiCache.FilesystemCache(os.path.join(tmpdir, 'compressed'), compress=True)
+        compressed.set_stream('big', (b'0' * 1024 for _ in range(100)), url='http://big')
+        assert compressed.stats()['bytes'] < 1024, _test_error
+        assert compressed.get('big').value == b'0' * 102400, _test_error
+        assert compressed.peek('big').metadata == {'url': 'http://big'}, _test_error
+        assert compressed.stats()['hits'] == 1, _test_error
+        try:
+            compressed.set_stream('big', (b'1' * 1024 if i < 10 else 1 / 0 for i in range(100)))
+        except ZeroDivisionError:
+            pass
+        assert compressed.get('big').value == b'0' * 102400, _test_error  # The failed write is discarded
+        assert [f for _, _, files in os.walk(compressed.root) for f in files if f.endswith('.tmp')] == [], \
+            _test_error
+    print(f"[OK] `test_cache_backends` successful")
+
+
+def test_request_key():
+    _test_error = f"[FAIL] `test_request_key` failed"
+    url = f"http://example.com/products?{'q=a&' * 200}"
+    key = apiCache.request_key('GET', url)
+    assert len(key) == 64 and key == apiCache.request_key('get', url), _test_error
+    assert key != apiCache.request_key('POST', url), _test_error
+    assert apiCache.request_key('POST', url, data={'a': 1, 'b': 2}) == \
+           apiCache.request_key('POST', url, data={'b': 2, 'a': 1}), _test_error
+    assert apiCache.request_key('POST', url, json_body={'a': 1}) != apiCache.request_key('POST', url), _test_error
+    assert apiCache.request_key('GET', url, headers={'User-Agent': 'x'}) == key, _test_error
+    assert apiCache.request_key('GET', url, headers={'Accept': 'application/json'}) != key, _test_error
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = apiCache.FilesystemCache(tmpdir)
+        cache.set(key, b'contents')
+        assert os.path.isfile(os.path.join(tmpdir, key[:2], key[2:4], f"{key}.cache")), _test_error
+        assert cache.get(key).value == b'contents', _test_error
+    print(f"[OK] `test_request_key` successful")
+
+
+def test_cache_purge():
+    _test_error = f"[FAIL] `test_cache_purge` failed"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        backends = [apiCache.MemoryCache(ttl=0.2),
+                    apiCache.FilesystemCache(os.path.join(tmpdir, 'fs'), ttl=0.2),
+                    apiCache.SQLiteCache(os.path.join(tmpdir, 'cache.db'), ttl=0.2)]
+        for cache in backends:
+            for i in range(50):
+                cache.set(f"old{i}", b'0123456789')
+            cache.set('validated', b'0123456789', etag='"v1"')
+            time.sleep(0.3)
+            for i in range(10):
+                cache.set(f"new{i}", b'0123456789')
+            assert 'old0' not in cache and 'old49' not in cache and 'validated' in cache, _test_error
+            assert cache.stats()['entries'] <= 11, _test_error
+            time.sleep(0.3)
+            assert cache.purge_expired() == 10 and cache.stats()['entries'] == 1, _test_error
+            cache.stale_ttl = 0.01  # Entries with validators are kept only 0.01s after they expire
+            assert cache.purge_expired() == 1 and 'validated' not in cache, _test_error
+            cache.set('validated', b'0123456789', etag='"v1"')
+            time.sleep(0.3)
+            assert cache.get('validated') is None and 'validated' not in cache, _test_error
+        assert len([f for _, _, files in os.walk(backends[1].root) for f in files]) == 0, _test_error
+        for cache in backends:
+            cache.close()
+    print(f"[OK] `test_cache_purge` successful")
+
+
+if __name__ == '__main__':
+    test_cache_backends()
+    test_request_key()
+    test_cache_purge()
@@ -1,10 +1,59 @@
+import concurrent.futures
+import gc
+import io
 import os
+import tempfile
 import time
+import weakref
 
 import pandas as pd
 import klsframe.utilities.dataframe as dfutils
 
 
+def test_get_df_rows():
+    _test_error = f"[FAIL] `test_get_df_rows` failed"
+    df = pd.DataFrame({'team': ['A', 'B', 'C', 'D', 'E', 'F'], 'points': [18, 22, 19, 14, 11, 10]})
+    assert len(dfutils.get_df_rows(df)) == 6, _test_error
+    assert dfutils.get_df_rows(df, 2) == {'team': 'C', 'points': 19}, _test_error
+    assert dfutils.get_df_rows(df, 10) == [], _test_error
+    assert dfutils.get_df_rows(df, 'first') == {'team': 'A', 'points': 18}, _test_error
+    assert dfutils.get_df_rows(df, 'last') == {'team': 'F', 'points': 10}, _test_error
+    assert [r['team'] for r in dfutils.get_df_rows(df, 'head-2')] == ['A', 'B'], _test_error
+    assert [r['team'] for r in dfutils.get_df_rows(df, 'tail-2')] == ['E', 'F'], _test_error
+    assert [r['team'] for r in dfutils.get_df_rows(df, '1-3')] == ['B', 'C', 'D'], _test_error
+    assert [r['team'] for r in dfutils.get_df_rows(df, '5,0,2-3,12')] == ['A', 'C', 'D', 'F'], _test_error
+    start = time.perf_counter()
+    assert [r['team'] for r in dfutils.get_df_rows(df, '4-50000000000,1')] == ['B', 'E', 'F'], _test_error
+    assert time.perf_counter() - start < 1, _test_error  # Ranges are compared as bounds, never expanded
+    assert dfutils.get_df_rows(df.set_index('team'), '0-10') == [], _test_error
+    selector = dfutils.compile_rindex('1,4')
+    view = dfutils.get_df_rows(df, selector, as_frame=True)
+    assert isinstance(view, pd.DataFrame) and list(view['team']) == ['B', 'E'], _test_error
+    labeled = df.set_index(pd.Index([10, 20, 30, 40, 50, 60]))
+    assert dfutils.get_df_rows(labeled, 'first') == {'team': 'A', 'points': 18}, _test_error
+    assert dfutils.get_df_rows(labeled.iloc[0:0], 'last') == [], _test_error
+    try:
+        dfutils.get_df_rows(df, 'middle')
+    except ValueError as e:
+        assert str(e) == "Unexpected value for parameter 'rindex'", _test_error
+    print(f"[OK] `test_get_df_rows` successful")
+
+
+def test_iter_df_rows():
+    _test_error = f"[FAIL] `test_iter_df_rows` failed"
+    df = pd.DataFrame({'team': ['A', 'B', 'C', 'D', 'E', 'F'], 'points': [18, 22, 19, 14, 11, 10]})
+    assert list(dfutils.iter_df_rows(df, chunk_size=4)) == dfutils.get_df_rows(df), _test_error
+    assert list(dfutils.iter_df_rows(df, 'last')) == [{'team': 'F', 'points': 10}], _test_error
+    batches = list(dfutils.iter_df_rows(df, '0-4', batch_size=2))
+    assert [len(b) for b in batches] == [2, 2, 1], _test_error
+    assert [r['team'] for b in batches for r in b] == ['A', 'B', 'C', 'D', 'E'], _test_error
+    try:
+        next(dfutils.iter_df_rows(df, batch_size=0))
+    except ValueError as e:
+        assert str(e) == "Unexpected value for parameter 'batch_size'. Only positive integer numbers allowed"
+    print(f"[OK] `test_iter_df_rows` successful")
+
+
 def test_multi_merge():
     _test_error = f"[FAIL] `test_multi_merge` failed"
     df1 = pd.DataFrame({'team': ['A', 'B', 'C', 'D'], 'points': [18, 22, 19, 14]})
@@ -28,6 +77,68 @@ def test_multi_merge():
     print(f"[OK] `test_multi_merge` successful")
 
 
+def test_multi_merge_index_strategy():
+    _test_error = f"[FAIL] `test_multi_merge_index_strategy` failed"
+    df1 = pd.DataFrame({'points': [14, 18, 22, 19], 'team': ['D', 'A', 'B', 'C']})
+    df2 = pd.DataFrame({'team': ['A', 'B', 'C'], 'assists': [4, 9, 14]})
+    df3 = pd.DataFrame({'team': ['F', 'C', 'D', 'E'], 'rebounds': [10, 17, 11, 10]})
+    for how in ['inner', 'outer', 'left']:
+        expected = dfutils.multi_merge([df1, df2, df3], on='team', how=how)
+        result = dfutils.multi_merge([df1, df2, df3], on='team', how=how, strategy='index')
+        assert result.equals(expected), _test_error
+    try:
+        dfutils.multi_merge([df1, df2, df3], on='team', how='right', strategy='index')
+    except ValueError as e:
+        assert str(e) == "Unsupported merge type for strategy 'index': 'right'. Allowed: inner|outer|left", _test_error
+    duplicated = pd.DataFrame({'team': ['A', 'A'], 'steals': [1, 2]})
+    assert dfutils.multi_merge([df2, duplicated], on='team', strategy='index').equals(
+        dfutils.multi_merge([df2, duplicated], on='team')), _test_error
+    shared = pd.DataFrame({'team': ['A', 'B'], 'assists': [1, 2]})  # Falls back: columns need suffixes
+    assert dfutils.multi_merge([df2, shared], on='team', how='outer', strategy='index').equals(
+        dfutils.multi_merge([df2, shared], on='team', how='outer')), _test_error
+    result = dfutils.multi_merge([df1, df2], on='team', how='outer', strategy='index', indicator=True)
+    assert list(result['_merge']) == ['both', 'both', 'both', 'left_only'], _test_error
+    try:
+        dfutils.multi_merge([df2, duplicated], on='team', strategy='index', validate='one_to_one')
+        assert False, _test_error
+    except pd.errors.MergeError:
+        pass
+    print(f"[OK] `test_multi_merge_index_strategy` successful")
+
+
+def test_plan_merge():
+    _test_error = f"[FAIL] `test_plan_merge` failed"
+    df1 = pd.DataFrame({'team': ['A', 'B', 'C', 'D', 'E', 'F'] * 3, 'points': range(18)})
+    df2 = pd.DataFrame({'team': ['A', 'B', 'C'], 'assists': [4, 9, 14]})
+    df3 = pd.DataFrame({'team': ['C', 'D', 'E', 'F'], 'rebounds': [10, 17, 11, 10]})
+    plan = dfutils.plan_merge([df1, df2, df3], on='team', names=['puntos', 'asistencias', 'rebotes'])
+    assert plan.order == [1, 2, 0] and plan.names == ['asistencias', 'rebotes', 'puntos'], _test_error
+    assert list(plan.keys) == ['C'], _test_error
+    assert plan.stats[0] == {'rows': 18, 'keys': 6, 'fanout': 3.0, 'estimated_rows': 3.0}, _test_error
+    planned = dfutils.multi_merge([df1, df2, df3], on='team', plan=plan)
+    sequential = dfutils.multi_merge([df1, df2, df3], on='team')
+    assert list(planned.columns) == list(sequential.columns), _test_error
+    assert planned.sort_values('points').to_string(index=False) == sequential.to_string(index=False), _test_error
+    df4 = pd.DataFrame({'team': ['A', 'B'], 'points': [1, 2]})
+    assert dfutils.plan_merge([df1, df4], on='team', how='outer').order == [0, 1], _test_error
+    coll = dfutils.DataFrameCollection({'puntos': df1, 'asistencias': df2, 'rebotes': df3})
+    assert coll.plan_combine(on='team', how='outer').names == ['asistencias', 'rebotes', 'puntos'], _test_error
+    assert coll.combine(on='team', how='outer').to_string() == \
+           coll.combine(on='team', how='outer', plan=False).to_string(), _test_error
+    for kwargs in [{'how': 'outer'}, {'exclude': 'rebotes'}]:
+        try:
+            coll.combine(on='team', plan=coll.plan_combine(on='team'), **kwargs)  # Plan for an inner merge
+            assert False, _test_error
+        except ValueError:
+            pass
+    try:
+        dfutils.multi_merge([df1, df2, df3], on=['team', 'points'], plan=plan)
+        assert False, _test_error
+    except ValueError:
+        pass
+    print(f"[OK] `test_plan_merge` successful")
+
+
 def test_class_df_collection():
     df1 = pd.DataFrame({'team': ['A', 'B', 'C', 'D'], 'points': [18, 22, 19, 14]})
     df2 = pd.DataFrame({'team': ['A', 'B', 'C'], 'assists': [4, 9, 14]})
@@ -39,6 +150,11 @@ def test_class_df_collection():
     print(coll)
     coll.to_excel('testing', exclude='mondongo')
     os.remove('testing.xlsx')
+    coll.to_excel('testing', include=['puntos', 'rebotes', 'mondongo'], streaming=True)
+    book = pd.read_excel('testing.xlsx', sheet_name=None)
+    os.remove('testing.xlsx')
+    assert list(book.keys()) == ['puntos', 'rebotes'], "[FAIL] `test_class_df_collection` failed"
+    assert book['rebotes'].equals(df3), "[FAIL] `test_class_df_collection` failed"
     b = dfutils.DataFrameCollection({'page1': pd.DataFrame(), 'page2': pd.DataFrame()})
     print(b)
     b = dfutils.DataFrameCollection(page1=pd.DataFrame(), page2=pd.DataFrame())
@@ -69,8 +185,183 @@ def test_class_df_collection_2():
     print(f"[OK] `test_class_df_collection_2` successful")
 
 
+def test_df_collection_save_load():
+    _test_error = f"[FAIL] `test_df_collection_save_load` failed"
+    df1 = pd.DataFrame({'team': ['A', 'B', 'C', 'D'], 'points': [18, 22, 19, 14]})
+    df2 = pd.DataFrame({'team': ['A', 'B', 'C'], 'assists': [4, 9, 14]})
+    coll = dfutils.DataFrameCollection({'puntos': df1, 'asistencias': df2})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        coll.save(tmpdir)
+        loaded = dfutils.DataFrameCollection.load(tmpdir)
+        assert list(loaded.keys()) == ['puntos', 'asistencias'], _test_error
+        assert isinstance(dict.__getitem__(loaded, 'puntos'), dfutils.LazyPage), _test_error
+        assert loaded['puntos'].equals(df1), _test_error
+        assert isinstance(dict.__getitem__(loaded, 'puntos'), pd.DataFrame), _test_error
+        assert isinstance(dict.__getitem__(loaded, 'asistencias'), dfutils.LazyPage), _test_error
+        assert loaded.get('asistencias').equals(df2), _test_error
+        coll.save(tmpdir, fmt='feather')
+        eager = dfutils.DataFrameCollection.load(tmpdir, lazy=False)
+        assert isinstance(dict.__getitem__(eager, 'asistencias'), pd.DataFrame), _test_error
+        assert eager['asistencias'].equals(df2), _test_error
+    print(f"[OK] `test_df_collection_save_load` successful")
+
+
+def test_df_collection_lazy_pages():
+    _test_error = f"[FAIL] `test_df_collection_lazy_pages` failed"
+    df1 = pd.DataFrame({'team': ['A', 'B', 'C', 'D'], 'points': [18, 22, 19, 14]})
+    df2 = pd.DataFrame({'team': ['A', 'B', 'C'], 'assists': [4, 9, 14]})
+    df3 = pd.DataFrame({'team': ['C', 'D', 'E', 'F'], 'rebounds': [10, 17, 11, 10]})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dfutils.DataFrameCollection({'puntos': df1, 'asistencias': df2, 'rebotes': df3}).save(tmpdir)
+        coll = dfutils.DataFrameCollection.load(tmpdir, memory_budget=1)
+        print(coll)
+        assert all(isinstance(v, dfutils.LazyPage) for v in dict.values(coll)), _test_error
+        assert coll.combine(on='team', include=['puntos', 'asistencias'])['assists'].sum() == 27, _test_error
+        assert isinstance(dict.__getitem__(coll, 'puntos'), dfutils.LazyPage), _test_error
+        assert isinstance(dict.__getitem__(coll, 'asistencias'), pd.DataFrame), _test_error
+        assert isinstance(dict.__getitem__(coll, 'rebotes'), dfutils.LazyPage), _test_error
+        coll.memory_budget = None
+        assert coll['puntos'].equals(df1) and coll['rebotes'].equals(df3), _test_error
+        assert coll.loaded_bytes() > 0 and len(coll._loaded_pages) == 3, _test_error
+        loaded = weakref.ref(coll['puntos'])
+        coll.update({'puntos': df1})
+        del coll['rebotes']
+        coll.pop('asistencias')
+        assert coll.loaded_bytes() == 0 and len(coll._loaded_pages) == 0, _test_error
+        gc.collect()
+        assert loaded() is None, _test_error  # The replaced page is no longer referenced
+        custom = dfutils.DataFrameCollection({'custom': dfutils.LazyPage(os.path.join(tmpdir, 'page-0.parquet'),
+                                                                          loader=pd.read_parquet)})
+        assert custom['custom'].equals(df1), _test_error
+    print(f"[OK] `test_df_collection_lazy_pages` successful")
+
+
+def test_df_collection_render():
+    _test_error = f"[FAIL] `test_df_collection_render` failed"
+    big = pd.DataFrame({'value': range(1000)})
+    coll = dfutils.DataFrameCollection({f"page{i}": big for i in range(25)})
+    preview = str(coll)
+    assert "... 5 more pages" in preview and "page19" in preview and "page20" not in preview, _test_error
+    assert "[1000 rows x 1 columns]" in preview and " 500 " not in preview, _test_error
+    stream = io.StringIO()
+    coll.render(stream, max_rows=4, max_pages=1)
+    assert stream.getvalue().count('\n') < 15, _test_error
+    full = dfutils.DataFrameCollection({'small': pd.DataFrame({'a': [1, 2]})}).to_string()
+    assert full == f"Page 'small'\n\n{pd.DataFrame({'a': [1, 2]}).to_string()}\n{'-' * 18} pg 1 {'-' * 18}\n", \
+        _test_error
+    print(f"[OK] `test_df_collection_render` successful")
+
+
+def test_group_and_aggregate():
+    _test_error = f"[FAIL] `test_group_and_aggregate` failed"
+    df = pd.DataFrame({'ip': ['10.0.0.1', '10.0.0.2', '10.0.0.1', '10.0.0.3', '10.0.0.1'],
+                       'port': [22, 80, 443, 22, 22], 'bytes': [10, 20, 30, 40, 50]})
+    expected = df.groupby('ip').size().reset_index(name='count')
+    assert dfutils.group_and_count(df, 'ip').equals(expected), _test_error
+    assert dfutils.group_and_count(df, 'ip', categorical=True).equals(expected), _test_error
+    result = dfutils.group_and_aggregate(df, ['ip'], {'ports': ('port', 'nunique'), 'total': ('bytes', 'sum')})
+    assert list(result.columns) == ['ip', 'count', 'ports', 'total'], _test_error
+    assert result['ip'].dtype == df['ip'].dtype, _test_error
+    assert result.iloc[0].tolist() == ['10.0.0.1', 3, 2, 90], _test_error
+    compact = dfutils.group_and_aggregate(dfutils.compact_dtypes(df, category_threshold=1.0), 'ip')
+    assert isinstance(compact['ip'].dtype, pd.CategoricalDtype) and compact['count'].tolist() == [3, 1, 1], \
+        _test_error
+    coll = dfutils.DataFrameCollection({'scan1': df, 'scan2': df.head(2)})
+    grouped = coll.group_and_aggregate('ip', {'total': ('bytes', 'sum')}, max_workers=2)
+    assert list(grouped.keys()) == ['scan1', 'scan2'] and len(grouped['scan2']) == 2, _test_error
+    print(f"[OK] `test_group_and_aggregate` successful")
+
+
+def _count_rows(df):
+    if len(df) == 0:
+        raise ValueError("Empty page")
+    return len(df)
+
+
+def test_df_collection_map_pages():
+    _test_error = f"[FAIL] `test_df_collection_map_pages` failed"
+    df1 = pd.DataFrame({'team': ['A', 'B', 'C', 'D'], 'points': [18, 22, 19, 14]})
+    df2 = pd.DataFrame({'team': ['A', 'B', 'C'], 'assists': [4, 9, 14]})
+    coll = dfutils.DataFrameCollection({'puntos': df1, 'vacia': pd.DataFrame(), 'asistencias': df2})
+    filtered = coll.map_pages(lambda df: df[df.iloc[:, 1] > 10], exclude='vacia')
+    assert list(filtered.keys()) == ['puntos', 'asistencias'] and len(filtered['asistencias']) == 1, _test_error
+    counts = coll.map_pages(_count_rows, executor='process', max_workers=2)
+    assert dict(counts.items()) == {'puntos': 4, 'asistencias': 3}, _test_error
+    assert isinstance(counts.errors['vacia'], ValueError), _test_error
+    try:
+        coll.map_pages(_count_rows, errors='raise')
+    except ValueError as e:
+        assert str(e) == "Empty page", _test_error
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        assert coll.map_pages(len, executor=executor)['vacia'] == 0, _test_error
+    print(f"[OK] `test_df_collection_map_pages` successful")
+
+
+def test_df_collection_optimize_memory():
+    _test_error = f"[FAIL] `test_df_collection_optimize_memory` failed"
+    df1 = pd.DataFrame({'team': ['A', 'B', 'C', 'D'] * 50, 'points': range(200), 'ratio': [0.5] * 200})
+    df2 = pd.DataFrame({'team': ['A', 'B', 'C'] * 10, 'assists': [4, 9, 14] * 10})
+    coll = dfutils.DataFrameCollection({'puntos': df1, 'asistencias': df2})
+    saved = coll.optimize_memory()
+    assert list(saved.keys()) == ['puntos', 'asistencias'] and all(v > 0 for v in saved.values()), _test_error
+    assert coll['puntos']['points'].dtype == 'int16', _test_error
+    assert coll['puntos']['ratio'].dtype == 'float64', _test_error
+    assert isinstance(coll['asistencias']['team'].dtype, pd.CategoricalDtype), _test_error
+    merged = coll.combine(on='team', how='inner')
+    assert isinstance(merged['team'].dtype, pd.CategoricalDtype), _test_error
+    assert merged['assists'].dtype == 'int8', _test_error
+    assert dfutils.compact_dtypes(df1, floats=True)['ratio'].dtype == 'float32', _test_error
+    nested = pd.DataFrame({'tags': [['a'], ['b'], ['a']] * 10, 'meta': [{'k': 1}] * 30, 'team': ['A', 'B', 'C'] * 10})
+    compact = dfutils.compact_dtypes(nested)
+    assert compact['tags'].dtype == object and compact['meta'].dtype == object, _test_error
+    assert isinstance(compact['team'].dtype, pd.CategoricalDtype), _test_error
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dfutils.DataFrameCollection({'puntos': df1}).save(tmpdir)
+        lazy = dfutils.DataFrameCollection.load(tmpdir)
+        original = weakref.ref(lazy['puntos'])
+        assert lazy.optimize_memory()['puntos'] > 0 and lazy.loaded_bytes() == 0, _test_error
+        gc.collect()
+        assert original() is None, _test_error  # The uncompacted frame is freed
+    print(f"[OK] `test_df_collection_optimize_memory` successful")
+
+
+def test_df_collection_from_excel():
+    _test_error = f"[FAIL] `test_df_collection_from_excel` failed"
+    df1 = pd.DataFrame({'team': ['A', 'B', 'C', 'D'], 'points': [18, 22, 19, 14]})
+    df2 = pd.DataFrame({'team': ['A', 'B', 'C'], 'assists': [4, 9, 14], 'steals': [1, 0, 2]})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        book = os.path.join(tmpdir, 'book')
+        dfutils.df_to_excel(book, {'puntos': df1, 'asistencias': df2})
+        coll = dfutils.DataFrameCollection.from_excel(f"{book}.xlsx", cache_dir=None)
+        assert list(coll.keys()) == ['puntos', 'asistencias'] and coll['asistencias'].equals(df2), _test_error
+        cache_dir = os.path.join(tmpdir, 'cache')
+        args = {'sheets': 'asistencias', 'usecols': ['team', 'assists'], 'cache_dir': cache_dir}
+        parsed = dfutils.DataFrameCollection.from_excel(f"{book}.xlsx", **args)
+        assert list(parsed['asistencias'].columns) == ['team', 'assists'], _test_error
+        cached = dfutils.DataFrameCollection.from_excel(f"{book}.xlsx", **args)
+        assert isinstance(dict.__getitem__(cached, 'asistencias'), dfutils.LazyPage), _test_error
+        assert cached['asistencias'].equals(parsed['asistencias']), _test_error
+        mixed = os.path.join(tmpdir, 'mixed')
+        dfutils.df_to_excel(mixed, {'mixto': pd.DataFrame({'value': ['x', 1, 2]})})
+        coll = dfutils.DataFrameCollection.from_excel(f"{mixed}.xlsx", cache_dir=cache_dir)
+        assert coll['mixto']['value'].tolist() == ['x', 1, 2], _test_error
+        assert len(os.listdir(cache_dir)) == 1, _test_error  # The failed cache entry is removed
+    print(f"[OK] `test_df_collection_from_excel` successful")
+
+
 if __name__ == '__main__':
+    test_get_df_rows()
+    test_iter_df_rows()
     test_multi_merge()
+    test_multi_merge_index_strategy()
+    test_plan_merge()
     test_class_df_collection()
     time.sleep(2)
     test_class_df_collection_2()
+    test_df_collection_save_load()
+    test_df_collection_lazy_pages()
+    test_df_collection_render()
+    test_group_and_aggregate()
+    test_df_collection_map_pages()
+    test_df_collection_optimize_memory()
+    test_df_collection_from_excel()
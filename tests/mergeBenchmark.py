@@ -0,0 +1,17 @@
+import time
+
+import pandas as pd
+import klsframe.utilities.dataframe as dfutils
+
+
+def benchmark_multi_merge(pages=10, rows=200000):
+    # Sequential merge vs. single multi-way join
+    dataframes = [pd.DataFrame({'key': range(rows), f"col{i}": range(rows)}) for i in range(pages)]
+    for strategy in ['reduce', 'index']:
+        start = time.perf_counter()
+        dfutils.multi_merge(dataframes, on='key', how='outer', strategy=strategy)
+        print(f"[INFO] multi_merge (strategy '{strategy}'): {time.perf_counter() - start:.3f} s")
+
+
+if __name__ == '__main__':
+    benchmark_multi_merge()
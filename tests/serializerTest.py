@@ -1,3 +1,11 @@
+import datetime
+import enum
+import json
+import math
+import os
+import tempfile
+import uuid
+
 import klsframe.utilities.serializer as _kser
 
 
@@ -27,5 +35,102 @@ def test_chunk_file_name():
                                        insert_before=_datetime_regex))
 
 
+def test_json():
+    _test_error = f"[FAIL] `test_json` failed"
+    obj = {'name': 'klsframe', 'tags': ['cli', 'gui'], 'nested': {'value': 1.5, 'none': None}}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'obj.json')
+        _kser.save_json(obj, path)
+        with open(path, 'r') as file:
+            assert '\n' not in file.read(), _test_error  # Compact by default
+        assert _kser.load_json(path) == obj, _test_error
+        _kser.save_json(obj, path, indent=2)
+        with open(path, 'r') as file:
+            assert file.read().startswith('{\n  "name"'), _test_error
+        assert _kser.load_json(path) == obj, _test_error
+        _kser.save_json({1: 'a'}, path)  # Non-str keys are supported by every backend
+        assert _kser.load_json(path) == {'1': 'a'}, _test_error
+    print(f"[OK] `test_json` successful ({_kser.JSON_BACKEND} backend)")
+
+
+class _Color(enum.Enum):
+    RED = 1
+
+
+def test_json_parity():
+    # Every backend must write and read the same documents as the json module
+    _test_error = f"[FAIL] `test_json_parity` failed"
+    obj = {'nan': float('nan'), 'inf': [float('inf'), -float('inf')], 'none': None, 'value': 0.1}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'obj.json')
+        _kser.save_json(obj, path)
+        with open(path, 'r') as file:
+            assert file.read() == json.dumps(obj, separators=(',', ':')), _test_error
+        loaded = _kser.load_json(path)
+        assert math.isnan(loaded['nan']) and loaded['inf'] == [float('inf'), -float('inf')], _test_error
+        assert loaded['none'] is None and loaded['value'] == 0.1, _test_error
+        for unsupported in (datetime.date(2024, 1, 1), datetime.datetime(2024, 1, 1, 12), {'set'}, uuid.uuid4(),
+                            _Color.RED):
+            try:
+                _kser.save_json({'value': unsupported}, path)
+                assert False, _test_error
+            except TypeError:
+                pass
+        for indent in (None, 0, 2, 4):
+            _kser.save_json({'a': [1, {'b': None}], 'c': []}, path, indent=indent)
+            with open(path, 'r') as file:
+                expected = json.dumps({'a': [1, {'b': None}], 'c': []}, indent=indent,
+                                      separators=(',', ':') if indent is None else None)
+                assert file.read() == expected, _test_error
+    print(f"[OK] `test_json_parity` successful ({_kser.JSON_BACKEND} backend)")
+
+
+def test_json_lines():
+    _test_error = f"[FAIL] `test_json_lines` failed"
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'records.jsonl')
+        assert _kser.save_jsonl(({'id': i, 'value': f"v{i}"} for i in range(1000)), path) == 1000, _test_error
+        assert _kser.save_jsonl([{'id': 1000}], path, append=True) == 1, _test_error
+        records = _kser.iter_jsonl(path)
+        assert next(records) == {'id': 0, 'value': 'v0'}, _test_error
+        records.close()
+        records = _kser.load_jsonl(path)
+        assert len(records) == 1001 and records[-1] == {'id': 1000}, _test_error
+        with open(path, 'a') as file:
+            file.write('\n{"id": \n')
+        try:
+            _kser.load_jsonl(path)
+            assert False, _test_error
+        except ValueError as e:
+            assert 'line 1003' in str(e), _test_error
+    print(f"[OK] `test_json_lines` successful")
+
+
+def test_yaml():
+    _test_error = f"[FAIL] `test_yaml` failed"
+    conf = {'title': 'NVD collector', 'banner': {'text': 'NVD Collector', 'style': 'default'},
+            'parameters': [{'name': 'target', 'type': 'string', 'regex': ['([0-9]{0,3}.){3}[0-9]{1,3}']}]}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'conf.yaml')
+        assert _kser.save_yaml(conf, path) == 0, _test_error
+        with open(path, 'r') as file:
+            assert file.readline() == 'title: NVD collector\n', _test_error  # Insertion order, block style
+        loaded = _kser.load_yaml(path)
+        assert loaded == conf, _test_error
+        loaded['title'] = 'modified'
+        assert _kser.load_yaml(path) == conf, _test_error  # The cached object is not modified
+        assert _kser._yaml_cache[os.path.abspath(path)][1] == conf, _test_error
+        with open(path, 'a') as file:
+            file.write('version: 2\n')
+        assert _kser.load_yaml(path)['version'] == 2, _test_error  # Modified files are parsed again
+        _kser.clear_yaml_cache()
+        assert _kser.load_yaml(path, use_cache=False)['version'] == 2 and not _kser._yaml_cache, _test_error
+    print(f"[OK] `test_yaml` successful ({_kser._YAML_LOADER.__name__})")
+
+
 if __name__ == '__main__':
     test_chunk_file_name()
+    test_json()
+    test_json_parity()
+    test_json_lines()
+    test_yaml()